@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+Скрипт для перестроения плоского индекса FAISS в сжатый индекс IVF-PQ.
+Векторы извлекаются из существующего индекса, повторное построение
+эмбеддингов не требуется.
+"""
+
+import os
+import sys
+import argparse
+import faiss
+
+def main():
+    """
+    Основная функция для построения индекса IVF-PQ
+    """
+    # Парсинг аргументов командной строки
+    parser = argparse.ArgumentParser(description="Перестроение индекса FAISS в IVF-PQ")
+    parser.add_argument("--input", type=str, default=os.environ.get("INDEX_PATH", "data/legal_index.faiss"),
+                        help="Путь к исходному плоскому индексу FAISS")
+    parser.add_argument("--output", type=str, default="data/legal_index_ivfpq.faiss",
+                        help="Путь для сохранения нового индекса")
+    parser.add_argument("--factory", type=str, default="IVF4096,PQ64",
+                        help="Строка index_factory для нового индекса")
+
+    args = parser.parse_args()
+
+    if not os.path.exists(args.input):
+        print(f"Ошибка: Файл индекса не найден по пути {args.input}.")
+        return 1
+
+    # Извлечение векторов из исходного индекса
+    flat_index = faiss.read_index(args.input)
+    vectors = flat_index.reconstruct_n(0, flat_index.ntotal)
+    print(f"Загружено {flat_index.ntotal} векторов размерности {flat_index.d}")
+
+    # Обучение и заполнение нового индекса (эмбеддинги E5 нормализованы, поэтому используется скалярное произведение)
+    index = faiss.index_factory(flat_index.d, args.factory, faiss.METRIC_INNER_PRODUCT)
+    print(f"Обучение индекса {args.factory}...")
+    index.train(vectors)
+    index.add(vectors)
+
+    faiss.write_index(index, args.output)
+    print(f"Индекс сохранен в {args.output}. "
+          f"Укажите INDEX_PATH={args.output} и настройте NPROBE для баланса скорости и точности поиска.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Скрипт для конвертации файла с чанками и ссылками из pickle в формат Arrow IPC.
+Файл Arrow загружается ботом через memory-map без десериализации всех строк.
+"""
+
+import os
+import sys
+import pickle
+import argparse
+import pyarrow as pa
+import pyarrow.ipc
+
+def main():
+    """
+    Основная функция для конвертации данных чанков
+    """
+    # Парсинг аргументов командной строки
+    parser = argparse.ArgumentParser(description="Конвертация данных чанков из pickle в Arrow IPC")
+    parser.add_argument("--input", type=str, default=os.environ.get("CHUNKS_DATA_PATH", "data/chunks_references.pkl"),
+                        help="Путь к файлу с чанками и ссылками в формате pickle")
+    parser.add_argument("--output", type=str, default="data/chunks.arrow",
+                        help="Путь для сохранения файла Arrow")
+
+    args = parser.parse_args()
+
+    if not os.path.exists(args.input):
+        print(f"Ошибка: Файл с чанками не найден по пути {args.input}.")
+        return 1
+
+    with open(args.input, "rb") as f:
+        chunks_data = pickle.load(f)
+
+    chunks = chunks_data["chunks"]
+    references = chunks_data["references"]
+
+    # Имя модели эмбеддингов сохраняется в метаданных схемы
+    metadata = {}
+    if "embedder_model" in chunks_data:
+        metadata["embedder_model"] = chunks_data["embedder_model"]
+
+    # large_string хранит смещения строк в int64: колонка остается одним непрерывным буфером
+    # даже для корпуса больше 2 ГБ, и доступ к чанку по номеру не перебирает части колонки
+    table = pa.table(
+        {
+            "id": pa.array(range(len(chunks)), type=pa.int64()),
+            "chunk": pa.array(chunks, type=pa.large_string()),
+            "reference": pa.array(references, type=pa.large_string()),
+        },
+        metadata=metadata
+    ).combine_chunks()
+
+    with pa.OSFile(args.output, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+    print(f"Сохранено {len(chunks)} чанков в {args.output}. "
+          f"Укажите CHUNKS_DATA_PATH={args.output} для загрузки чанков через memory-map.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Скрипт для предварительной загрузки языковой модели в локальную директорию.
+Запускается на этапе сборки образа, чтобы бот при старте загружал модель
+с диска без обращения к сети.
+"""
+
+import os
+import sys
+import argparse
+from dotenv import load_dotenv
+from huggingface_hub import login
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+def main():
+    """
+    Основная функция для загрузки и сохранения модели
+    """
+    # Загрузка переменных окружения
+    load_dotenv()
+
+    # Парсинг аргументов командной строки
+    parser = argparse.ArgumentParser(description="Загрузка языковой модели LegalGuardian в локальную директорию")
+    parser.add_argument("--model", type=str, default="google/gemma-3-4b-it",
+                        help="Название модели на Hugging Face Hub")
+    parser.add_argument("--output-dir", type=str, default="data/models/gemma-3-4b-it",
+                        help="Директория для сохранения модели")
+    parser.add_argument("--huggingface-token", type=str, default=os.environ.get("HUGGINGFACE_TOKEN"),
+                        help="Токен для доступа к моделям Hugging Face")
+
+    args = parser.parse_args()
+
+    try:
+        if args.huggingface_token:
+            login(token=args.huggingface_token)
+
+        print(f"Загрузка модели {args.model}...")
+        tokenizer = AutoTokenizer.from_pretrained(args.model)
+        # torch_dtype="auto" сохраняет тип весов из чекпойнта (без расширения до float32)
+        model = AutoModelForCausalLM.from_pretrained(args.model, torch_dtype="auto")
+
+        # Сохранение модели и токенизатора в локальную директорию
+        os.makedirs(args.output_dir, exist_ok=True)
+        tokenizer.save_pretrained(args.output_dir)
+        # Веса сохраняются в формате safetensors, который бот загружает без лишнего копирования
+        model.save_pretrained(args.output_dir, safe_serialization=True)
+
+        print(f"Модель сохранена в {args.output_dir}. "
+              f"Укажите LLM_MODEL={args.output_dir} для запуска бота без загрузки из сети.")
+        return 0
+
+    except Exception as e:
+        print(f"Ошибка при загрузке модели: {e}")
+        import traceback
+        traceback.print_exc()
+        return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,6 +5,7 @@
 
 import os
 import sys
+import logging
 import argparse
 from dotenv import load_dotenv
 
@@ -14,6 +15,8 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')
 # Импорт функции запуска бота
 from telegram_bot.bot import run_bot, initialize_bot
 
+logger = logging.getLogger(__name__)
+
 def main():
     """
     Основная функция для запуска бота
@@ -38,24 +41,26 @@ def main():
     
     # Проверка наличия обязательных аргументов
     if not args.telegram_token:
-        print("Ошибка: Не указан токен Telegram бота. "
-              "Укажите его через аргумент --telegram-token или переменную окружения TELEGRAM_TOKEN.")
+        logger.error("Ошибка: Не указан токен Telegram бота. "
+                     "Укажите его через аргумент --telegram-token или переменную окружения TELEGRAM_TOKEN.")
         return 1
     
     # Проверка наличия индекса и данных чанков
     if not os.path.exists(args.index_path):
-        print(f"Ошибка: Файл индекса не найден по пути {args.index_path}. "
-              "Убедитесь, что индекс создан или укажите правильный путь через аргумент --index-path.")
+        logger.error("Ошибка: Файл индекса не найден по пути %s. "
+                     "Убедитесь, что индекс создан или укажите правильный путь через аргумент --index-path.",
+                     args.index_path)
         return 1
     
     if not os.path.exists(args.chunks_data_path):
-        print(f"Ошибка: Файл с чанками не найден по пути {args.chunks_data_path}. "
-              "Убедитесь, что данные чанков созданы или укажите правильный путь через аргумент --chunks-data-path.")
+        logger.error("Ошибка: Файл с чанками не найден по пути %s. "
+                     "Убедитесь, что данные чанков созданы или укажите правильный путь через аргумент --chunks-data-path.",
+                     args.chunks_data_path)
         return 1
     
     # Запуск бота
     try:
-        print(f"Запуск бота LegalGuardian с моделью {args.model}...")
+        logger.info("Запуск бота LegalGuardian с моделью %s...", args.model)
         
         # Инициализация и запуск бота
         bot = initialize_bot(
@@ -66,19 +71,24 @@ def main():
             huggingface_token=args.huggingface_token
         )
         
+        # Использование uvloop в качестве цикла событий, если он доступен (недоступен на Windows)
+        try:
+            import uvloop
+            uvloop.install()
+        except ImportError:
+            pass
+        
         # Запуск бота
         bot.run()
         
         return 0
         
     except KeyboardInterrupt:
-        print("\nРабота бота остановлена пользователем.")
+        logger.info("Работа бота остановлена пользователем.")
         return 0
         
     except Exception as e:
-        print(f"Ошибка при запуске бота: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Ошибка при запуске бота: %s", e)
         return 1
 
 if __name__ == "__main__":
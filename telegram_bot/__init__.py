@@ -5,11 +5,14 @@
 Этот пакет содержит модули для:
 - Поиска релевантной информации в правовых документах (retriever.py)
 - Генерации ответов на основе найденных документов (generator.py)
+- Хранения истории разговоров с пользователями (memory.py)
+- Кэширования ответов на близкие по смыслу вопросы (semantic_cache.py)
 - Взаимодействия с пользователями через Telegram (bot.py)
 """
 
 from .retriever import LegalRetriever
-from .generator import LegalAnswerGenerator, ConversationMemory
+from .generator import LegalAnswerGenerator
+from .memory import ConversationMemory
 from .bot import LegalGuardianBot, initialize_bot, run_bot
 
 __all__ = [
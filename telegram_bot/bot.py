@@ -6,18 +6,29 @@
 """
 
 import os
+import json
+import hashlib
 import logging
 import asyncio
-from typing import Dict
+import threading
+from typing import Any, Dict, List, Optional, Tuple
 from datetime import datetime
+from cachetools import LRUCache, TTLCache
 from dotenv import load_dotenv
-from telegram import Update
+from telegram import Message, Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 from huggingface_hub import login
 
+try:
+    import redis.asyncio as redis
+except ImportError:
+    redis = None
+
 # Импорт наших модулей
 from telegram_bot.retriever import LegalRetriever
-from telegram_bot.generator import LegalAnswerGenerator, ConversationMemory
+from telegram_bot.generator import LegalAnswerGenerator
+from telegram_bot.memory import ConversationMemory
+from telegram_bot.semantic_cache import SemanticCache
 
 # Настройка логирования
 logging.basicConfig(
@@ -26,6 +37,16 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Перезапись последнего сообщения истории в Redis. Если список уже удален (истек TTL
+# или история очищена), сообщение дописывается заново, а не теряется
+REWRITE_TAIL_SCRIPT = """
+if redis.call("EXISTS", KEYS[1]) == 1 then
+    redis.call("LSET", KEYS[1], -1, ARGV[1])
+else
+    redis.call("RPUSH", KEYS[1], ARGV[1])
+end
+"""
+
 class LegalGuardianBot:
     """
     Telegram бот для ответов на юридические вопросы
@@ -43,7 +64,37 @@ class LegalGuardianBot:
         max_chunks: int = 5,
         max_tokens: int = 1024,
         temperature: float = 0.7,
-        top_p: float = 0.9
+        top_p: float = 0.9,
+        faiss_mmap: bool = False,
+        low_memory: bool = True,
+        model_cache_dir: str = None,
+        quantization: str = "int8",
+        redis_url: str = None,
+        response_cache_ttl: int = 3600,
+        conversation_ttl: int = 86400,
+        generation_batch_size: int = 8,
+        generation_batch_window: float = 0.01,
+        search_batch_size: int = 32,
+        search_batch_window: float = 0.01,
+        prefix_cache: bool = False,
+        max_users_in_memory: int = 10000,
+        nprobe: int = 16,
+        index_factory: str = None,
+        index_factory_min_vectors: int = 50000,
+        faiss_gpu: bool = None,
+        embedding_onnx_dir: str = None,
+        embedding_onnx_int8: bool = False,
+        compile_embedding_model: bool = False,
+        compile_model: bool = False,
+        attn_implementation: str = None,
+        draft_model: str = None,
+        num_assistant_tokens: int = 5,
+        stream_responses: bool = False,
+        stream_edit_interval: float = 1.0,
+        max_concurrent_streams: int = 2,
+        semantic_cache: bool = False,
+        semantic_cache_threshold: float = 0.95,
+        sampling: bool = False
     ):
         """
         Инициализация бота
@@ -59,6 +110,36 @@ class LegalGuardianBot:
             max_tokens: Максимальное количество токенов в ответе
             temperature: Температура генерации
             top_p: Параметр top_p для генерации
+            faiss_mmap: Загружать ли индекс FAISS через memory-map
+            low_memory: Отключать ли предвычисленные таблицы IVFPQ для экономии памяти
+            model_cache_dir: Директория для кэша модели в формате torch (None - без кэша)
+            quantization: Квантизация весов модели на GPU ("none", "int8" или "nf4")
+            redis_url: URL Redis для кэша ответов (None - кэш отключен)
+            response_cache_ttl: Время жизни ответа в кэше в секундах
+            conversation_ttl: Время хранения истории разговора в Redis в секундах
+            generation_batch_size: Максимальное количество запросов, генерируемых одним вызовом модели
+            generation_batch_window: Время ожидания запросов для объединения в батч в секундах
+            search_batch_size: Максимальное количество запросов, обрабатываемых одним поиском по индексу
+            search_batch_window: Время ожидания запросов для объединения в батч поиска в секундах
+            prefix_cache: Переиспользовать ли общий KV-кэш системного промпта
+            max_users_in_memory: Максимальное количество пользователей, история которых хранится в памяти
+            nprobe: Количество просматриваемых кластеров для индексов FAISS семейства IVF
+            index_factory: Строка index_factory сжатого индекса, в который перестраивается плоский индекс (None - не перестраивается)
+            index_factory_min_vectors: Минимальное количество векторов плоского индекса для перестроения
+            faiss_gpu: Переносить ли индекс FAISS на GPU (None - при наличии GPU)
+            embedding_onnx_dir: Директория модели эмбеддингов в формате ONNX для запуска на CPU (None - PyTorch)
+            embedding_onnx_int8: Квантизовать ли ONNX-модель эмбеддингов в INT8
+            compile_embedding_model: Компилировать ли модель эмбеддингов через torch.compile при запуске на GPU
+            compile_model: Компилировать ли модель через torch.compile при запуске
+            attn_implementation: Реализация механизма внимания (None - выбор автоматически)
+            draft_model: Черновая модель для спекулятивного декодирования (None - не используется)
+            num_assistant_tokens: Количество токенов, предлагаемых черновой моделью за шаг
+            stream_responses: Отправлять ли ответ по мере генерации, редактируя сообщение
+            stream_edit_interval: Минимальный интервал между обновлениями сообщения в секундах
+            max_concurrent_streams: Максимальное количество одновременных потоковых генераций
+            semantic_cache: Отвечать ли на близкие по смыслу вопросы ранее сгенерированными ответами
+            semantic_cache_threshold: Минимальное косинусное сходство вопросов для ответа из семантического кэша
+            sampling: Использовать ли сэмплирование вместо жадного декодирования
         """
         self.telegram_token = telegram_token
         self.index_path = index_path
@@ -70,17 +151,76 @@ class LegalGuardianBot:
         self.max_tokens = max_tokens
         self.temperature = temperature
         self.top_p = top_p
+        self.faiss_mmap = faiss_mmap
+        self.low_memory = low_memory
+        self.model_cache_dir = model_cache_dir
+        self.quantization = quantization
+        self.response_cache_ttl = response_cache_ttl
+        self.conversation_ttl = conversation_ttl
+        self.generation_batch_size = generation_batch_size
+        self.generation_batch_window = generation_batch_window
+        self.search_batch_size = search_batch_size
+        self.search_batch_window = search_batch_window
+        self.prefix_cache = prefix_cache
+        self.nprobe = nprobe
+        self.index_factory = index_factory
+        self.index_factory_min_vectors = index_factory_min_vectors
+        self.faiss_gpu = faiss_gpu
+        self.embedding_onnx_dir = embedding_onnx_dir
+        self.embedding_onnx_int8 = embedding_onnx_int8
+        self.compile_embedding_model = compile_embedding_model
+        self.compile_model = compile_model
+        self.attn_implementation = attn_implementation
+        self.draft_model = draft_model
+        self.num_assistant_tokens = num_assistant_tokens
+        self.stream_responses = stream_responses
+        self.stream_edit_interval = stream_edit_interval
+        self.max_concurrent_streams = max_concurrent_streams
+        self.use_semantic_cache = semantic_cache
+        self.semantic_cache_threshold = semantic_cache_threshold
+        self.sampling = sampling
+        
+        # Кэш ответов по смысловой близости вопросов (создается после загрузки ретривера)
+        self.semantic_cache: Optional[SemanticCache] = None
+        
+        # Клиент Redis для кэша ответов и истории разговоров
+        self.redis_client = None
+        if redis_url:
+            if redis is None:
+                raise ImportError("Для кэша ответов необходим пакет redis. Установите его: pip install redis")
+            self.redis_client = redis.from_url(redis_url)
         
         # Хранилище истории разговоров для каждого пользователя
-        self.user_conversations: Dict[int, ConversationMemory] = {}
+        # (используется, если Redis не настроен). При переполнении вытесняются
+        # давно неактивные пользователи, их история начнется заново
+        self.user_conversations: LRUCache = LRUCache(maxsize=max_users_in_memory)
+        
+        # Недавние ответы на вопросы пользователей для мгновенного ответа на повторы
+        self.recent_answers: TTLCache = TTLCache(maxsize=1024, ttl=600)
+        self.recent_answers_lock = asyncio.Lock()
         
         # Индикатор инициализации компонентов бота
         self.is_initialized = False
         
+        # Очередь запросов на генерацию и фоновая задача, объединяющая их в батчи
+        self._gen_queue: Optional[asyncio.Queue] = None
+        self._gen_task: Optional[asyncio.Task] = None
+        
+        # Очередь поисковых запросов и фоновая задача, объединяющая их в батчи
+        self._search_queue: Optional[asyncio.Queue] = None
+        self._search_task: Optional[asyncio.Task] = None
+        
+        # События остановки потоковой генерации для команды /cancel
+        self._active_generations: Dict[int, threading.Event] = {}
+        # Ограничение числа одновременных потоковых генераций на общей модели
+        self._stream_semaphore: Optional[asyncio.Semaphore] = None
+        
         # Статистика использования
         self.stats = {
             "total_queries": 0,
             "legal_queries": 0,
+            "cache_lookups": 0,
+            "cache_hits": 0,
             "start_time": datetime.now()
         }
     
@@ -98,34 +238,308 @@ class LegalGuardianBot:
                 login(token=self.huggingface_token)
                 logger.info("Авторизация в Hugging Face Hub успешна")
             
-            # Инициализация компонентов
-            logger.info("Инициализация LegalRetriever...")
-            self.retriever = LegalRetriever(
-                index_path=self.index_path,
-                chunks_data_path=self.chunks_data_path,
-                top_k=self.max_chunks
+            # Загрузка ретривера (диск) и генератора (сеть и GPU) выполняется параллельно
+            logger.info("Инициализация LegalRetriever и LegalAnswerGenerator...")
+            self.retriever, self.generator = await asyncio.gather(
+                asyncio.to_thread(self._create_retriever),
+                asyncio.to_thread(self._create_generator)
             )
             
-            logger.info("Инициализация LegalAnswerGenerator...")
-            self.generator = LegalAnswerGenerator(
-                model_name=self.llm_model_name,
-                max_tokens=self.max_tokens,
-                temperature=self.temperature,
-                top_p=self.top_p,
-                huggingface_token=self.huggingface_token,
-                max_chunks=self.max_chunks
-            )
+            if self.use_semantic_cache:
+                self.semantic_cache = SemanticCache(dim=self.retriever.index.d, threshold=self.semantic_cache_threshold)
+            
+            # Запуск фоновой обработки очередей поиска и генерации
+            self._search_queue = asyncio.Queue()
+            self._search_task = asyncio.create_task(self._search_worker())
+            self._gen_queue = asyncio.Queue()
+            self._gen_task = asyncio.create_task(self._generation_worker())
+            self._stream_semaphore = asyncio.Semaphore(self.max_concurrent_streams)
             
             self.is_initialized = True
             logger.info("Инициализация бота завершена успешно")
             
         except Exception as e:
-            logger.error(f"Ошибка при инициализации бота: {e}")
+            logger.error("Ошибка при инициализации бота: %s", e)
             import traceback
             traceback.print_exc()
             raise
     
-    def get_conversation_memory(self, user_id: int) -> ConversationMemory:
+    def _create_retriever(self) -> LegalRetriever:
+        """
+        Создание ретривера и прогрев страничного кэша индекса
+        
+        Returns:
+            Объект LegalRetriever
+        """
+        retriever = LegalRetriever(
+            index_path=self.index_path,
+            chunks_data_path=self.chunks_data_path,
+            top_k=self.max_chunks,
+            use_mmap=self.faiss_mmap,
+            low_memory=self.low_memory,
+            nprobe=self.nprobe,
+            index_factory=self.index_factory,
+            index_factory_min_vectors=self.index_factory_min_vectors,
+            use_gpu=self.faiss_gpu,
+            onnx_dir=self.embedding_onnx_dir,
+            onnx_int8=self.embedding_onnx_int8,
+            compile_model=self.compile_embedding_model
+        )
+        
+        # Прогрев страничного кэша, чтобы первый запрос не ждал page faults
+        if self.faiss_mmap:
+            retriever.prefault_index()
+        
+        logger.info("LegalRetriever инициализирован")
+        return retriever
+    
+    def _create_generator(self) -> LegalAnswerGenerator:
+        """
+        Создание генератора ответов
+        
+        Returns:
+            Объект LegalAnswerGenerator
+        """
+        generator = LegalAnswerGenerator(
+            model_name=self.llm_model_name,
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+            top_p=self.top_p,
+            huggingface_token=self.huggingface_token,
+            max_chunks=self.max_chunks,
+            model_cache_dir=self.model_cache_dir,
+            quantization=self.quantization,
+            prefix_cache=self.prefix_cache,
+            compile_model=self.compile_model,
+            attn_implementation=self.attn_implementation,
+            draft_model_name=self.draft_model,
+            num_assistant_tokens=self.num_assistant_tokens,
+            sampling=self.sampling,
+            max_batch_size=self.generation_batch_size
+        )
+        
+        logger.info("LegalAnswerGenerator инициализирован")
+        return generator
+    
+    async def _collect_batch(self, queue: asyncio.Queue, batch_size: int, batch_window: float) -> List[tuple]:
+        """
+        Ожидание первого запроса в очереди и сбор остальных в пределах окна батчинга
+        
+        Args:
+            queue: очередь запросов, последний элемент каждого запроса - future для результата
+            batch_size: максимальный размер батча
+            batch_window: время ожидания запросов в секундах
+            
+        Returns:
+            Батч запросов, ожидание которых не отменено
+        """
+        loop = asyncio.get_running_loop()
+        batch = [await queue.get()]
+        
+        # Ждем остальные запросы в пределах окна батчинга
+        deadline = loop.time() + batch_window
+        while len(batch) < batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        
+        # Запросы, ожидание которых уже отменено, не обрабатываем
+        return [item for item in batch if not item[-1].done()]
+    
+    async def _search_worker(self):
+        """
+        Фоновая задача: собирает поисковые запросы из очереди в батчи и выполняет
+        поиск одним проходом модели эмбеддингов и одним вызовом индекса
+        """
+        while True:
+            batch = await self._collect_batch(self._search_queue, self.search_batch_size, self.search_batch_window)
+            if not batch:
+                continue
+            
+            queries = [query for query, _ in batch]
+            try:
+                results = await asyncio.to_thread(self.retriever.search_batch, queries)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+    
+    async def search(self, query: str) -> List[Dict[str, Any]]:
+        """
+        Постановка запроса в очередь поиска и ожидание результатов
+        
+        Args:
+            query: запрос пользователя
+            
+        Returns:
+            Список найденных чанков
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._search_queue.put((query, future))
+        return await future
+    
+    async def _generation_worker(self):
+        """
+        Фоновая задача: собирает запросы из очереди в батчи и генерирует ответы
+        """
+        while True:
+            batch = await self._collect_batch(self._gen_queue, self.generation_batch_size, self.generation_batch_window)
+            if not batch:
+                continue
+            
+            requests = [(query, chunks, memory) for query, chunks, memory, _ in batch]
+            try:
+                answers = await asyncio.to_thread(self.generator.generate_batch, requests)
+            except Exception as e:
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            
+            for (*_, future), answer in zip(batch, answers):
+                if not future.done():
+                    future.set_result(answer)
+    
+    async def generate_answer(
+        self,
+        query: str,
+        retrieved_chunks: List[Dict[str, Any]],
+        conversation_memory: ConversationMemory
+    ) -> str:
+        """
+        Постановка запроса в очередь генерации и ожидание ответа
+        
+        Args:
+            query: запрос пользователя
+            retrieved_chunks: найденные чанки
+            conversation_memory: история разговора пользователя
+            
+        Returns:
+            Ответ на вопрос
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._gen_queue.put((query, retrieved_chunks, conversation_memory, future))
+        return await future
+    
+    async def _stream_answer(
+        self,
+        update: Update,
+        query: str,
+        retrieved_chunks: List[Dict[str, Any]],
+        conversation_memory: ConversationMemory
+    ) -> Tuple[Optional[str], Message, str]:
+        """
+        Потоковая генерация ответа с обновлением сообщения пользователю по мере появления текста
+        
+        Генерация выполняется вне очереди батчей: каждый потоковый ответ запускает
+        собственный вызов generate на общей модели, поэтому число одновременных
+        генераций ограничено max_concurrent_streams.
+        
+        Args:
+            update: входящее обновление Telegram
+            query: запрос пользователя
+            retrieved_chunks: найденные чанки
+            conversation_memory: история разговора пользователя
+            
+        Returns:
+            Кортеж (итоговый ответ или None, если генерация остановлена; отправленное сообщение;
+            последний показанный в сообщении текст)
+        """
+        user_id = update.effective_user.id
+        message = await update.message.reply_text("Формирую ответ...")
+        
+        stop_event = threading.Event()
+        self._active_generations[user_id] = stop_event
+        
+        loop = asyncio.get_running_loop()
+        stream = self.generator.generate_answer_stream(query, retrieved_chunks, conversation_memory, stop_event)
+        end_of_stream = object()
+        answer = None
+        shown_text = ""
+        cancelled = False
+        finished = False
+        try:
+            async with self._stream_semaphore:
+                last_edit = loop.time()
+                while True:
+                    # Итератор блокируется до появления новых токенов, поэтому читается в потоке
+                    text = await asyncio.to_thread(next, stream, end_of_stream)
+                    if text is end_of_stream:
+                        break
+                    if text is None:
+                        # Генерация остановлена до сохранения ответа в историю
+                        cancelled = True
+                        break
+                    answer = text
+                    
+                    if text.strip() and text != shown_text and loop.time() - last_edit >= self.stream_edit_interval:
+                        await message.edit_text(text)
+                        shown_text = text
+                        last_edit = loop.time()
+            finished = True
+        finally:
+            # При ошибке правки сообщения генерация в фоновом потоке останавливается
+            if not finished:
+                stop_event.set()
+            if self._active_generations.get(user_id) is stop_event:
+                del self._active_generations[user_id]
+        
+        # /cancel, пришедшая после сохранения ответа, не отменяет уже готовый ответ
+        if cancelled:
+            await message.edit_text("Генерация ответа остановлена.")
+            return None, message, shown_text
+        
+        return answer, message, shown_text
+    
+    async def _get_recent_answer(self, user_id: int, query: str) -> Optional[str]:
+        """
+        Получение недавнего ответа на тот же вопрос пользователя
+        
+        Args:
+            user_id: ID пользователя в Telegram
+            query: запрос пользователя
+            
+        Returns:
+            Ответ или None, если вопрос не задавался недавно
+        """
+        key = (user_id, " ".join(query.lower().split()))
+        async with self.recent_answers_lock:
+            return self.recent_answers.get(key)
+    
+    async def _set_recent_answer(self, user_id: int, query: str, answer: str):
+        """
+        Сохранение ответа на вопрос пользователя
+        
+        Args:
+            user_id: ID пользователя в Telegram
+            query: запрос пользователя
+            answer: ответ
+        """
+        key = (user_id, " ".join(query.lower().split()))
+        async with self.recent_answers_lock:
+            self.recent_answers[key] = answer
+    
+    async def _clear_recent_answers(self, user_id: int):
+        """
+        Удаление недавних ответов пользователя
+        
+        Args:
+            user_id: ID пользователя в Telegram
+        """
+        async with self.recent_answers_lock:
+            for key in [key for key in self.recent_answers.keys() if key[0] == user_id]:
+                self.recent_answers.pop(key, None)
+    
+    async def get_conversation_memory(self, user_id: int) -> ConversationMemory:
         """
         Получение или создание объекта ConversationMemory для пользователя
         
@@ -135,10 +549,137 @@ class LegalGuardianBot:
         Returns:
             Объект ConversationMemory для пользователя
         """
+        if self.redis_client is not None:
+            conversation_memory = ConversationMemory(max_history=self.max_history)
+            try:
+                data = await self.redis_client.lrange(f"chat:{user_id}", 0, -1)
+                conversation_memory.messages.extend(json.loads(item) for item in data)
+            except Exception as e:
+                logger.warning("Ошибка при загрузке истории разговора из Redis: %s", e)
+            return conversation_memory
+        
         if user_id not in self.user_conversations:
             self.user_conversations[user_id] = ConversationMemory(max_history=self.max_history)
         return self.user_conversations[user_id]
     
+    async def save_conversation_memory(self, user_id: int, conversation_memory: ConversationMemory):
+        """
+        Сохранение истории разговора пользователя в Redis
+        
+        История хранится списком Redis: новые сообщения дописываются в конец,
+        а список обрезается до max_history, поэтому история не перезаписывается целиком.
+        Сохраненное последнее сообщение, к которому присоединено новое той же роли,
+        перезаписывается на месте скриптом Lua (или дописывается, если списка уже нет).
+        
+        Args:
+            user_id: ID пользователя в Telegram
+            conversation_memory: история разговора
+        """
+        unsaved = conversation_memory.unsaved_messages
+        if self.redis_client is None or (unsaved == 0 and not conversation_memory.tail_modified):
+            return
+        
+        key = f"chat:{user_id}"
+        new_messages = conversation_memory.get_last_n_messages(unsaved) if unsaved else []
+        try:
+            async with self.redis_client.pipeline(transaction=True) as pipe:
+                # Измененное сообщение - последнее в Redis и предшествует несохраненным локально
+                if conversation_memory.tail_modified and unsaved < len(conversation_memory.messages):
+                    modified_message = conversation_memory.messages[-unsaved - 1]
+                    pipe.eval(REWRITE_TAIL_SCRIPT, 1, key, json.dumps(modified_message, ensure_ascii=False))
+                if new_messages:
+                    pipe.rpush(key, *(json.dumps(message, ensure_ascii=False) for message in new_messages))
+                pipe.ltrim(key, -self.max_history, -1)
+                pipe.expire(key, self.conversation_ttl)
+                await pipe.execute()
+            conversation_memory.unsaved_messages = 0
+            conversation_memory.tail_modified = False
+        except Exception as e:
+            logger.warning("Ошибка при сохранении истории разговора в Redis: %s", e)
+    
+    async def reset_conversation_memory(self, user_id: int):
+        """
+        Сброс истории разговора пользователя
+        
+        Args:
+            user_id: ID пользователя в Telegram
+        """
+        if self.redis_client is not None:
+            try:
+                await self.redis_client.delete(f"chat:{user_id}")
+            except Exception as e:
+                logger.warning("Ошибка при удалении истории разговора из Redis: %s", e)
+            return
+        
+        self.user_conversations[user_id] = ConversationMemory(max_history=self.max_history)
+    
+    async def count_active_users(self) -> int:
+        """
+        Подсчет пользователей с сохраненной историей разговора
+        
+        Returns:
+            Количество пользователей
+        """
+        if self.redis_client is None:
+            return len(self.user_conversations)
+        
+        count = 0
+        async for _ in self.redis_client.scan_iter(match="chat:*"):
+            count += 1
+        return count
+    
+    def _get_response_cache_key(self, query: str, retrieved_chunks: List[Dict[str, Any]]) -> str:
+        """
+        Формирование ключа кэша ответа по запросу и найденным чанкам
+        
+        Args:
+            query: запрос пользователя
+            retrieved_chunks: найденные чанки
+            
+        Returns:
+            Ключ для Redis
+        """
+        normalized_query = " ".join(query.lower().split())
+        chunk_ids = ",".join(str(chunk["id"]) for chunk in retrieved_chunks)
+        digest = hashlib.sha1(f"{normalized_query}|{chunk_ids}".encode("utf-8")).hexdigest()
+        return f"answer:{digest}"
+    
+    async def _get_cached_response(self, cache_key: str) -> Optional[str]:
+        """
+        Получение ответа из кэша
+        
+        Args:
+            cache_key: ключ кэша
+            
+        Returns:
+            Сохраненный ответ или None
+        """
+        self.stats["cache_lookups"] += 1
+        try:
+            cached = await self.redis_client.get(cache_key)
+        except Exception as e:
+            logger.warning("Ошибка при чтении кэша ответов: %s", e)
+            return None
+        
+        if cached is None:
+            return None
+        
+        self.stats["cache_hits"] += 1
+        return cached.decode("utf-8")
+    
+    async def _set_cached_response(self, cache_key: str, answer: str):
+        """
+        Сохранение ответа в кэш
+        
+        Args:
+            cache_key: ключ кэша
+            answer: ответ для сохранения
+        """
+        try:
+            await self.redis_client.setex(cache_key, self.response_cache_ttl, answer)
+        except Exception as e:
+            logger.warning("Ошибка при записи в кэш ответов: %s", e)
+    
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """
         Обработка команды /start
@@ -147,7 +688,7 @@ class LegalGuardianBot:
         username = update.effective_user.username or "пользователь"
         
         # Создаем новую историю разговора для пользователя
-        self.user_conversations[user_id] = ConversationMemory(max_history=self.max_history)
+        await self.reset_conversation_memory(user_id)
         
         # Отправляем приветственное сообщение
         welcome_message = (
@@ -166,18 +707,21 @@ class LegalGuardianBot:
         )
         
         await update.message.reply_text(welcome_message)
-        logger.info(f"Новый пользователь: {user_id} ({username})")
+        logger.info("Новый пользователь: %s (%s)", user_id, username)
     
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """
         Обработка команды /help
         """
+        # Остановить можно только потоковую генерацию
+        cancel_help = "/cancel - Остановить формирование ответа\n" if self.stream_responses else ""
         help_message = (
             "🔍 *LegalGuardian - юридический ассистент*\n\n"
             "*Доступные команды:*\n"
             "/start - Начать работу с ботом\n"
             "/help - Показать эту справку\n"
-            "/clear - Очистить историю разговора\n\n"
+            "/clear - Очистить историю разговора\n"
+            f"{cancel_help}\n"
             
             "*Как использовать:*\n"
             "• Просто задавайте вопросы, связанные с российским законодательством\n"
@@ -201,13 +745,25 @@ class LegalGuardianBot:
         user_id = update.effective_user.id
         
         # Очищаем историю
-        if user_id in self.user_conversations:
-            self.user_conversations[user_id].clear()
-        else:
-            self.user_conversations[user_id] = ConversationMemory(max_history=self.max_history)
+        await self.reset_conversation_memory(user_id)
+        await self._clear_recent_answers(user_id)
         
         await update.message.reply_text("История разговора очищена. Вы можете начать новую беседу.")
-        logger.info(f"История разговора очищена для пользователя {user_id}")
+        logger.info("История разговора очищена для пользователя %s", user_id)
+    
+    async def cancel_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """
+        Обработка команды /cancel - остановка генерации текущего ответа
+        """
+        user_id = update.effective_user.id
+        
+        stop_event = self._active_generations.get(user_id)
+        if stop_event is None:
+            await update.message.reply_text("Сейчас ответ не формируется.")
+            return
+        
+        stop_event.set()
+        logger.info("Генерация ответа остановлена пользователем %s", user_id)
     
     async def stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """
@@ -220,14 +776,22 @@ class LegalGuardianBot:
         if self.stats["total_queries"] > 0:
             legal_percentage = (self.stats["legal_queries"] / self.stats["total_queries"]) * 100
         
+        active_users = await self.count_active_users()
+        
         stats_message = (
             "📊 *Статистика бота*\n\n"
             f"Время работы: {uptime_str}\n"
             f"Всего запросов: {self.stats['total_queries']}\n"
             f"Юридических запросов: {self.stats['legal_queries']} ({legal_percentage:.1f}%)\n"
-            f"Активных пользователей: {len(self.user_conversations)}\n"
+            f"Активных пользователей: {active_users}\n"
         )
         
+        if self.redis_client is not None:
+            hit_rate = 0
+            if self.stats["cache_lookups"] > 0:
+                hit_rate = (self.stats["cache_hits"] / self.stats["cache_lookups"]) * 100
+            stats_message += f"Попаданий в кэш ответов: {self.stats['cache_hits']} ({hit_rate:.1f}%)\n"
+        
         await update.message.reply_text(stats_message, parse_mode="Markdown")
     
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -248,7 +812,7 @@ class LegalGuardianBot:
         self.stats["total_queries"] += 1
         
         # Получаем или создаем историю разговора для пользователя
-        conversation_memory = self.get_conversation_memory(user_id)
+        conversation_memory = await self.get_conversation_memory(user_id)
         
         # Отправляем индикатор набора текста
         await update.message.chat.send_action("typing")
@@ -262,14 +826,39 @@ class LegalGuardianBot:
                     "Извините, я могу отвечать только на юридические вопросы, связанные с российским законодательством. "
                     "Пожалуйста, задайте вопрос, касающийся правовых норм, законов или юридических процедур."
                 )
-                logger.info(f"Неюридический запрос от пользователя {user_id}: '{query}'")
+                logger.info("Неюридический запрос от пользователя %s: '%s'", user_id, query)
                 return
             
             # Обновляем статистику юридических запросов
             self.stats["legal_queries"] += 1
             
+            # Повторный вопрос пользователя обслуживается без поиска и генерации
+            answer = await self._get_recent_answer(user_id, query)
+            if answer is not None:
+                logger.info("Повторный запрос пользователя %s, ответ взят из локального кэша", user_id)
+                conversation_memory.add_message("user", query)
+                conversation_memory.add_message("assistant", answer)
+                await self.save_conversation_memory(user_id, conversation_memory)
+                await update.message.reply_text(answer)
+                return
+            
+            # Близкий по смыслу вопрос обслуживается без поиска и генерации
+            query_embedding = None
+            if self.semantic_cache is not None:
+                # Эмбеддинг строится в отдельном потоке, чтобы не блокировать цикл событий
+                query_embedding = await asyncio.to_thread(self.retriever.embed_query, query)
+                answer = self.semantic_cache.get(query_embedding)
+                if answer is not None:
+                    logger.info("Ответ для пользователя %s взят из семантического кэша", user_id)
+                    conversation_memory.add_message("user", query)
+                    conversation_memory.add_message("assistant", answer)
+                    await self.save_conversation_memory(user_id, conversation_memory)
+                    await self._set_recent_answer(user_id, query, answer)
+                    await update.message.reply_text(answer)
+                    return
+            
             # Поиск релевантных документов
-            retrieved_chunks = self.retriever.search(query, is_legal_question=True)
+            retrieved_chunks = await self.search(query)
             
             # Если ничего не найдено
             if not retrieved_chunks:
@@ -277,32 +866,63 @@ class LegalGuardianBot:
                     "К сожалению, я не нашел релевантной информации по вашему запросу в моей базе знаний. "
                     "Попробуйте переформулировать вопрос или задать более конкретный запрос."
                 )
-                logger.info(f"Нет результатов поиска для запроса пользователя {user_id}: '{query}'")
+                logger.info("Нет результатов поиска для запроса пользователя %s: '%s'", user_id, query)
                 return
             
-            # Генерация ответа
-            answer = self.generator.generate_answer(
-                user_query=query,
-                retrieved_chunks=retrieved_chunks,
-                conversation_memory=conversation_memory
-            )
+            # Проверка кэша ответов
+            cache_key = None
+            answer = None
+            sent_message = None
+            shown_text = None
+            if self.redis_client is not None:
+                cache_key = self._get_response_cache_key(query, retrieved_chunks)
+                answer = await self._get_cached_response(cache_key)
             
-            # Проверка качества ответа
-            if not self.generator.is_legal_answer(query, answer):
-                # Если ответ не прошел проверку качества
-                await update.message.reply_text(
-                    "Извините, я не смог сформировать качественный ответ на основе имеющейся у меня информации. "
-                    "Попробуйте задать более конкретный вопрос или уточнить, что именно вас интересует."
-                )
-                logger.warning(f"Ответ низкого качества для пользователя {user_id}: '{query}'")
-                return
+            if answer is not None:
+                logger.info("Ответ для пользователя %s взят из кэша", user_id)
+                conversation_memory.add_message("user", query)
+                conversation_memory.add_message("assistant", answer)
+                await self.save_conversation_memory(user_id, conversation_memory)
+            else:
+                # Генерация ответа
+                if self.stream_responses:
+                    answer, sent_message, shown_text = await self._stream_answer(update, query, retrieved_chunks, conversation_memory)
+                    if answer is None:
+                        return
+                else:
+                    answer = await self.generate_answer(query, retrieved_chunks, conversation_memory)
+                await self.save_conversation_memory(user_id, conversation_memory)
+                
+                # Проверка качества ответа
+                if not self.generator.is_legal_answer(query, answer):
+                    # Если ответ не прошел проверку качества
+                    low_quality_message = (
+                        "Извините, я не смог сформировать качественный ответ на основе имеющейся у меня информации. "
+                        "Попробуйте задать более конкретный вопрос или уточнить, что именно вас интересует."
+                    )
+                    if sent_message is not None:
+                        await sent_message.edit_text(low_quality_message)
+                    else:
+                        await update.message.reply_text(low_quality_message)
+                    logger.warning("Ответ низкого качества для пользователя %s: '%s'", user_id, query)
+                    return
+                
+                if cache_key is not None:
+                    await self._set_cached_response(cache_key, answer)
+            
+            await self._set_recent_answer(user_id, query, answer)
+            if query_embedding is not None:
+                self.semantic_cache.add(query_embedding, answer)
             
-            # Отправка ответа пользователю
-            await update.message.reply_text(answer)
-            logger.info(f"Ответ отправлен пользователю {user_id}")
+            # Отправка ответа пользователю (при потоковой генерации - окончательная правка сообщения)
+            if sent_message is None:
+                await update.message.reply_text(answer)
+            elif shown_text != answer:
+                await sent_message.edit_text(answer)
+            logger.info("Ответ отправлен пользователю %s", user_id)
             
         except Exception as e:
-            logger.error(f"Ошибка при обработке сообщения от пользователя {user_id}: {e}")
+            logger.error("Ошибка при обработке сообщения от пользователя %s: %s", user_id, e)
             await update.message.reply_text(
                 "Произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте позже или задайте другой вопрос."
             )
@@ -311,28 +931,38 @@ class LegalGuardianBot:
         """
         Обработка ошибок в обработчиках сообщений
         """
-        logger.error(f"Ошибка в обработчике: {context.error}")
+        logger.error("Ошибка в обработчике: %s", context.error)
         if update and isinstance(update, Update) and update.effective_chat:
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
                 text="Произошла ошибка при обработке запроса. Пожалуйста, попробуйте позже."
             )
     
-    def run(self):
+    async def run_async(self):
         """
-        Запуск бота
+        Асинхронный запуск бота в текущем цикле событий
         """
-        # Создание и настройка приложения бота
-        application = Application.builder().token(self.telegram_token).build()
-        
-        # Инициализация компонентов бота
-        asyncio.run(self.initialize())
+        # Создание и настройка приложения бота. HTTP/2 и пул соединений позволяют
+        # переиспользовать одно TLS-соединение для всех запросов к Bot API
+        application = (
+            Application.builder()
+            .token(self.telegram_token)
+            .http_version("2")
+            .get_updates_http_version("2")
+            .connection_pool_size(64)
+            # Параллельная обработка сообщений: запросы разных пользователей попадают
+            # в общий батч генерации, а /cancel обрабатывается во время генерации
+            .concurrent_updates(True)
+            .build()
+        )
         
         # Регистрация обработчиков команд
         application.add_handler(CommandHandler("start", self.start_command))
         application.add_handler(CommandHandler("help", self.help_command))
         application.add_handler(CommandHandler("clear", self.clear_command))
         application.add_handler(CommandHandler("stats", self.stats_command))
+        if self.stream_responses:
+            application.add_handler(CommandHandler("cancel", self.cancel_command))
         
         # Регистрация обработчика текстовых сообщений
         application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
@@ -340,16 +970,37 @@ class LegalGuardianBot:
         # Регистрация обработчика ошибок
         application.add_error_handler(self.error_handler)
         
-        # Запуск бота
-        logger.info("Запуск бота...")
-        application.run_polling()
+        await application.initialize()
+        try:
+            # Инициализация компонентов бота в том же цикле событий
+            await self.initialize()
+            
+            # Запуск бота
+            logger.info("Запуск бота...")
+            await application.start()
+            await application.updater.start_polling()
+            
+            # Работаем до остановки процесса
+            await asyncio.Event().wait()
+        finally:
+            if application.updater.running:
+                await application.updater.stop()
+            if application.running:
+                await application.stop()
+            await application.shutdown()
+    
+    def run(self):
+        """
+        Запуск бота
+        """
+        asyncio.run(self.run_async())
 
 
 def initialize_bot(
     telegram_token: str = None,
     index_path: str = None,
     chunks_data_path: str = None,
-    llm_model_name: str = "google/gemma-3-4b-it",
+    llm_model_name: str = None,
     huggingface_token: str = None
 ):
     """
@@ -359,7 +1010,7 @@ def initialize_bot(
         telegram_token: Токен бота в Telegram
         index_path: Путь к файлу индекса FAISS
         chunks_data_path: Путь к файлу с чанками и ссылками
-        llm_model_name: Название модели для генерации ответов
+        llm_model_name: Название модели или путь к локальной директории с моделью
         huggingface_token: Токен для доступа к моделям Hugging Face
     
     Returns:
@@ -373,6 +1024,7 @@ def initialize_bot(
     index_path = index_path or os.environ.get("INDEX_PATH")
     chunks_data_path = chunks_data_path or os.environ.get("CHUNKS_DATA_PATH")
     huggingface_token = huggingface_token or os.environ.get("HUGGINGFACE_TOKEN")
+    llm_model_name = llm_model_name or os.environ.get("LLM_MODEL", "google/gemma-3-4b-it")
     
     # Проверка наличия обязательных параметров
     if not telegram_token:
@@ -396,14 +1048,44 @@ def initialize_bot(
             max_chunks=int(os.environ.get("MAX_CHUNKS", 5)),
             max_tokens=int(os.environ.get("MAX_TOKENS", 1024)),
             temperature=float(os.environ.get("TEMPERATURE", 0.7)),
-            top_p=float(os.environ.get("TOP_P", 0.9))
+            top_p=float(os.environ.get("TOP_P", 0.9)),
+            faiss_mmap=os.environ.get("FAISS_MMAP", "0") == "1",
+            low_memory=os.environ.get("FAISS_LOW_MEMORY", "1") == "1",
+            model_cache_dir=os.environ.get("MODEL_CACHE_DIR"),
+            quantization=os.environ.get("QUANTIZATION", "int8"),
+            redis_url=os.environ.get("REDIS_URL"),
+            response_cache_ttl=int(os.environ.get("RESPONSE_CACHE_TTL", 3600)),
+            conversation_ttl=int(os.environ.get("CONVERSATION_TTL", 86400)),
+            generation_batch_size=int(os.environ.get("GENERATION_BATCH_SIZE", 8)),
+            generation_batch_window=float(os.environ.get("GENERATION_BATCH_WINDOW", 0.01)),
+            search_batch_size=int(os.environ.get("SEARCH_BATCH_SIZE", 32)),
+            search_batch_window=float(os.environ.get("SEARCH_BATCH_WINDOW", 0.01)),
+            prefix_cache=os.environ.get("PREFIX_KV_CACHE", "0") == "1",
+            max_users_in_memory=int(os.environ.get("MAX_USERS_IN_MEM", 10000)),
+            nprobe=int(os.environ.get("NPROBE", 16)),
+            index_factory=os.environ.get("INDEX_FACTORY") or None,
+            index_factory_min_vectors=int(os.environ.get("INDEX_FACTORY_MIN_VECTORS", 50000)),
+            faiss_gpu=os.environ["FAISS_GPU"] == "1" if os.environ.get("FAISS_GPU") else None,
+            embedding_onnx_dir=os.environ.get("EMBEDDING_ONNX_DIR") or None,
+            embedding_onnx_int8=os.environ.get("EMBEDDING_ONNX_INT8", "0") == "1",
+            compile_embedding_model=os.environ.get("COMPILE_EMBEDDING_MODEL", "0") == "1",
+            compile_model=os.environ.get("COMPILE_MODEL", "0") == "1",
+            attn_implementation=os.environ.get("ATTN_IMPLEMENTATION") or None,
+            draft_model=os.environ.get("DRAFT_MODEL") or None,
+            num_assistant_tokens=int(os.environ.get("NUM_ASSISTANT_TOKENS", 5)),
+            stream_responses=os.environ.get("STREAM_RESPONSES", "0") == "1",
+            stream_edit_interval=float(os.environ.get("STREAM_EDIT_INTERVAL", 1.0)),
+            max_concurrent_streams=int(os.environ.get("MAX_CONCURRENT_STREAMS", 2)),
+            semantic_cache=os.environ.get("SEMANTIC_CACHE", "0") == "1",
+            semantic_cache_threshold=float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", 0.95)),
+            sampling=os.environ.get("SAMPLING", "0") == "1"
         )
         
         logger.info("Бот успешно инициализирован")
         return bot
         
     except Exception as e:
-        logger.error(f"Ошибка при инициализации бота: {e}")
+        logger.error("Ошибка при инициализации бота: %s", e)
         import traceback
         traceback.print_exc()
         raise
@@ -421,7 +1103,7 @@ def run_bot():
         bot.run()
         
     except Exception as e:
-        logger.error(f"Ошибка при запуске бота: {e}")
+        logger.error("Ошибка при запуске бота: %s", e)
         import traceback
         traceback.print_exc()
 
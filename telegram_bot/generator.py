@@ -5,13 +5,21 @@
 релевантных юридических документов.
 """
 
+import hashlib
 import logging
 import os
 import re
+import copy
+import threading
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
-from typing import List, Dict, Any, Optional
+from transformers import (
+    AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, DynamicCache, MaxLengthCriteria,
+    StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer, pipeline
+)
+from transformers.utils import is_flash_attn_2_available
+from typing import List, Dict, Any, Iterator, Literal, Optional, Tuple
 from huggingface_hub import login
+from telegram_bot.memory import ConversationMemory
 from dotenv import load_dotenv
 
 # Настройка логирования
@@ -21,54 +29,24 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-class ConversationMemory:
+# Фиксированные длины промпта, до которых дополняются входные данные,
+# чтобы статический KV-кэш не перекомпилировался на каждой новой длине
+PROMPT_LENGTH_BUCKETS = (512, 1024, 2048)
+
+class StopOnEvent(StoppingCriteria):
     """
-    Класс для управления историей разговора
+    Критерий остановки генерации по внешнему событию (например, команде /cancel)
     """
     
-    def __init__(self, max_history: int = 8):
-        """
-        Инициализация памяти разговора
-        
-        Args:
-            max_history: максимальное количество последних сообщений для хранения
-        """
-        self.messages = []
-        self.max_history = max_history
-    
-    def add_message(self, role: str, content: str):
+    def __init__(self, stop_event: threading.Event):
         """
-        Добавление сообщения в историю
-        
         Args:
-            role: роль отправителя (user или assistant)
-            content: содержание сообщения
+            stop_event: событие, установка которого прерывает генерацию
         """
-        # Проверка валидности роли
-        if role not in ["user", "assistant"]:
-            raise ValueError(f"Недопустимая роль: {role}. Используйте 'user' или 'assistant'")
-        
-        # Добавление сообщения
-        self.messages.append({"role": role, "content": content})
-        
-        # Если история превысила максимальную длину, удаляем старые сообщения
-        if len(self.messages) > self.max_history:
-            self.messages = self.messages[-self.max_history:]
-    
-    def get_history(self) -> List[Dict[str, str]]:
-        """
-        Получение истории разговора
-        
-        Returns:
-            Список сообщений в формате [{"role": role, "content": content}, ...]
-        """
-        return self.messages.copy()
+        self.stop_event = stop_event
     
-    def clear(self):
-        """
-        Очистка истории разговора
-        """
-        self.messages = []
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return torch.full((input_ids.shape[0],), self.stop_event.is_set(), dtype=torch.bool, device=input_ids.device)
 
 
 class LegalAnswerGenerator:
@@ -76,6 +54,25 @@ class LegalAnswerGenerator:
     Генератор ответов на юридические вопросы на основе LLM
     """
     
+    # Фразы, по которым ответ определяется как отказ отвечать
+    REFUSAL_PHRASES = (
+        "не могу дать юридическую консультацию",
+        "не могу предоставить юридическую консультацию",
+        "я не юрист",
+        "не могу дать профессиональный совет",
+        "обратитесь к юристу",
+        "я не могу комментировать",
+        "не относится к юридической тематике",
+        "не в моей компетенции"
+    )
+    
+    # Юридическая терминология, которая должна присутствовать в ответе
+    LEGAL_ANSWER_TERMS = (
+        "закон", "право", "статья", "кодекс", "законодательств",
+        "норматив", "постановлен", "суд", "юридическ", "правоотношен",
+        "федеральн", "нормативно-правов"
+    )
+    
     def __init__(
         self,
         model_name: str = "google/gemma-3-4b-it",
@@ -83,7 +80,16 @@ class LegalAnswerGenerator:
         temperature: float = 0.7,
         top_p: float = 0.9,
         huggingface_token: Optional[str] = None,
-        max_chunks: int = 5
+        max_chunks: int = 5,
+        model_cache_dir: Optional[str] = None,
+        quantization: Literal["none", "int8", "nf4"] = "int8",
+        prefix_cache: bool = False,
+        compile_model: bool = False,
+        attn_implementation: Optional[str] = None,
+        draft_model_name: Optional[str] = None,
+        num_assistant_tokens: int = 5,
+        sampling: bool = False,
+        max_batch_size: int = 1
     ):
         """
         Инициализация генератора ответов
@@ -95,6 +101,19 @@ class LegalAnswerGenerator:
             top_p: вероятность отсечения (nucleus sampling)
             huggingface_token: токен для доступа к моделям Hugging Face
             max_chunks: максимальное количество чанков для использования в контексте
+            model_cache_dir: директория для кэша собранной модели в формате torch (.pt);
+                             если None, кэш не используется
+            quantization: квантизация весов при загрузке на GPU ("none", "int8" или "nf4")
+            prefix_cache: переиспользовать ли общий KV-кэш системного промпта
+            compile_model: компилировать ли прямой проход модели через torch.compile
+            attn_implementation: реализация механизма внимания ("flash_attention_2", "sdpa" или "eager");
+                                 если None, выбирается автоматически
+            draft_model_name: название небольшой черновой модели для спекулятивного декодирования
+                              (должна использовать тот же токенизатор); если None, не используется
+            num_assistant_tokens: количество токенов, предлагаемых черновой моделью за один шаг
+            sampling: использовать ли сэмплирование (temperature, top_p); по умолчанию
+                      используется жадное декодирование
+            max_batch_size: максимальный размер батча генерации (используется при прогреве)
         """
         self.model_name = model_name
         self.max_tokens = max_tokens
@@ -102,9 +121,32 @@ class LegalAnswerGenerator:
         self.top_p = top_p
         self.huggingface_token = huggingface_token or os.environ.get("HUGGINGFACE_TOKEN")
         self.max_chunks = max_chunks
+        self.model_cache_dir = os.path.expanduser(model_cache_dir) if model_cache_dir else None
+        self.quantization = quantization
+        self.prefix_cache = prefix_cache
+        self.compile_model = compile_model
+        self.attn_implementation = attn_implementation
+        self.draft_model_name = draft_model_name
+        self.num_assistant_tokens = num_assistant_tokens
+        self.sampling = sampling
+        self.max_batch_size = max_batch_size
+        
+        # Компиляция фраз отказа и юридических терминов в регулярные выражения для проверки ответа за один проход
+        self._refusal_re = re.compile("|".join(map(re.escape, self.REFUSAL_PHRASES)))
+        self._legal_terms_re = re.compile("|".join(map(re.escape, self.LEGAL_ANSWER_TERMS)))
+        
+        if quantization not in ("none", "int8", "nf4"):
+            raise ValueError(f"Недопустимый тип квантизации: {quantization}. Используйте 'none', 'int8' или 'nf4'")
         
         # Инициализация модели
         self._initialize_model()
+        
+        # Токены неизменной начальной части диалога вычисляются один раз
+        self._initialize_system_prefix()
+        
+        self._system_prefix_kv = None
+        if self.prefix_cache:
+            self._initialize_system_prefix_cache()
     
     def _initialize_model(self):
         """
@@ -126,15 +168,47 @@ class LegalAnswerGenerator:
             self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
             logger.info(f"Используется устройство: {self.device}")
             
-            # Инициализация токенизатора
-            self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+            # Gemma обучена в bfloat16: в float16 возможны переполнения и NaN, поэтому
+            # float16 используется только на GPU без поддержки bfloat16 (до Ampere)
+            if self.device.type == "cuda" and not torch.cuda.is_bf16_supported():
+                self.torch_dtype = torch.float16
+            else:
+                self.torch_dtype = torch.bfloat16
             
-            # Инициализация модели
-            self.model = AutoModelForCausalLM.from_pretrained(
-                self.model_name,
-                torch_dtype=torch.float16 if self.device.type == "cuda" else torch.float32,
-                device_map="auto" if self.device.type == "cuda" else None
-            )
+            cache_path = self._get_model_cache_path()
+            
+            # Без кэша или при нечитаемом кэше модель загружается из HF, а кэш перезаписывается
+            if not (cache_path and os.path.exists(cache_path) and self._load_model_cache(cache_path)):
+                # Инициализация токенизатора
+                self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+                
+                # Инициализация модели
+                self.model = AutoModelForCausalLM.from_pretrained(
+                    self.model_name,
+                    torch_dtype=self.torch_dtype,
+                    device_map="auto" if self.device.type == "cuda" else None,
+                    attn_implementation=self._get_attn_implementation(),
+                    quantization_config=self._get_quantization_config(),
+                    # Веса safetensors отображаются в память и загружаются сразу на устройство
+                    # без промежуточной полной копии в RAM
+                    low_cpu_mem_usage=True,
+                    use_safetensors=True
+                )
+                
+                if cache_path:
+                    self._save_model_cache(cache_path)
+            
+            # Черновая модель не входит в кэш и загружается отдельно
+            self.draft_model = self._load_draft_model() if self.draft_model_name else None
+            
+            # Компиляция выполняется после сохранения в кэш: скомпилированная модель не сериализуется
+            if self.compile_model:
+                self._compile_model()
+            
+            # Однократные затраты (контекст CUDA, cuBLAS, аллокатор, компиляция) оплачиваются
+            # до начала приема сообщений, а не первым пользователем
+            if self.device.type == "cuda" or self.compile_model:
+                self._warmup_model()
             
             logger.info(f"Модель {self.model_name} успешно загружена")
             
@@ -142,6 +216,163 @@ class LegalAnswerGenerator:
             logger.error(f"Ошибка при загрузке модели: {e}")
             raise
     
+    def _load_draft_model(self):
+        """
+        Загрузка черновой модели для спекулятивного декодирования
+        
+        Returns:
+            Черновая модель на том же устройстве, что и основная
+        """
+        logger.info(f"Загрузка черновой модели: {self.draft_model_name}")
+        
+        draft_model = AutoModelForCausalLM.from_pretrained(
+            self.draft_model_name,
+            torch_dtype=self.model.dtype,
+            device_map="auto" if self.device.type == "cuda" else None,
+            attn_implementation=self._get_attn_implementation(),
+            low_cpu_mem_usage=True,
+            use_safetensors=True
+        )
+        draft_model.eval()
+        
+        return draft_model
+    
+    def _compile_model(self):
+        """
+        Компиляция прямого прохода модели через torch.compile
+        (сама компиляция выполняется при прогреве в _warmup_model)
+        """
+        if not hasattr(torch, "compile"):
+            logger.warning("torch.compile недоступен (требуется torch>=2.2), модель не компилируется")
+            return
+        
+        logger.info("Компиляция модели через torch.compile...")
+        
+        # Компилируется сама модель, а не pipeline; dynamic=True исключает перекомпиляцию на каждой длине
+        self.model.forward = torch.compile(self.model.forward, mode="reduce-overhead", fullgraph=False, dynamic=True)
+    
+    def _warmup_model(self):
+        """
+        Прогрев модели через тот же путь генерации, что и у запросов пользователей:
+        одиночный запрос на каждой фиксированной длине промпта и батч максимального
+        размера на наименьшей длине
+        """
+        logger.info("Прогрев модели...")
+        
+        warmup_runs = [(1, length) for length in PROMPT_LENGTH_BUCKETS]
+        if self.max_batch_size > 1:
+            warmup_runs.append((self.max_batch_size, PROMPT_LENGTH_BUCKETS[0]))
+        
+        with torch.inference_mode():
+            for batch_size, length in warmup_runs:
+                warmup_ids = torch.full((length,), self.tokenizer.bos_token_id, dtype=torch.long)
+                # Генерация останавливается через несколько токенов, но max_new_tokens не меняется,
+                # поэтому статический кэш создается того же размера, что и для реальных запросов.
+                # Блоки аллокатора CUDA остаются в кэше и переиспользуются первыми запросами
+                self._generate_padded(
+                    [warmup_ids] * batch_size,
+                    stopping_criteria=StoppingCriteriaList([MaxLengthCriteria(max_length=length + 4)])
+                )
+        
+        logger.info("Прогрев модели завершен")
+    
+    def _get_attn_implementation(self) -> str:
+        """
+        Выбор реализации механизма внимания
+        
+        Returns:
+            Явно заданная реализация; иначе "flash_attention_2", если FlashAttention-2
+            доступен на GPU, и "sdpa" в остальных случаях
+        """
+        if self.attn_implementation:
+            logger.info(f"Используется реализация внимания: {self.attn_implementation}")
+            return self.attn_implementation
+        
+        if self.device.type == "cuda" and is_flash_attn_2_available():
+            logger.info("Используется реализация внимания: flash_attention_2")
+            return "flash_attention_2"
+        
+        logger.info("FlashAttention-2 недоступен, используется SDPA")
+        return "sdpa"
+    
+    def _get_quantization_config(self) -> Optional[BitsAndBytesConfig]:
+        """
+        Получение конфигурации квантизации bitsandbytes
+        
+        Returns:
+            Конфигурация квантизации или None, если квантизация не используется
+        """
+        # bitsandbytes работает только на GPU
+        if self.quantization == "none" or self.device.type != "cuda":
+            return None
+        
+        logger.info(f"Используется квантизация весов: {self.quantization}")
+        
+        if self.quantization == "int8":
+            return BitsAndBytesConfig(load_in_8bit=True, llm_int8_threshold=6.0)
+        
+        return BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=self.torch_dtype,
+            bnb_4bit_use_double_quant=True
+        )
+    
+    def _get_model_cache_path(self) -> Optional[str]:
+        """
+        Получение пути к файлу кэша модели
+        
+        Returns:
+            Путь к файлу .pt или None, если кэш отключен
+        """
+        if not self.model_cache_dir:
+            return None
+        
+        # Встроенный hash() для строк меняется между запусками, поэтому используем sha1
+        # Реализация внимания сохраняется в конфигурации модели, поэтому тоже входит в ключ
+        attn_implementation = self.attn_implementation or "auto"
+        cache_key = hashlib.sha1(
+            f"{self.model_name}|{self.quantization}|{self.torch_dtype}|{attn_implementation}".encode("utf-8")
+        ).hexdigest()
+        return os.path.join(self.model_cache_dir, f"{cache_key}.pt")
+    
+    def _load_model_cache(self, cache_path: str) -> bool:
+        """
+        Загрузка токенизатора и модели из кэша
+        
+        Args:
+            cache_path: путь к файлу кэша
+            
+        Returns:
+            True, если модель загружена; False, если кэш не удалось прочитать
+            (например, после обновления transformers или bitsandbytes) и модель
+            нужно загрузить заново с перезаписью кэша
+        """
+        # Загрузка готовой модели и токенизатора из кэша без повторного разбора конфигурации HF
+        logger.info(f"Загрузка модели из кэша: {cache_path}")
+        try:
+            self.tokenizer, self.model = torch.load(cache_path, map_location=self.device, weights_only=False)
+            return True
+        except Exception as e:
+            logger.warning(f"Не удалось загрузить модель из кэша, модель будет загружена заново: {e}")
+            return False
+    
+    def _save_model_cache(self, cache_path: str):
+        """
+        Сохранение токенизатора и модели в кэш
+        
+        Args:
+            cache_path: путь к файлу кэша
+        """
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_path = f"{cache_path}.tmp"
+            torch.save((self.tokenizer, self.model), tmp_path)
+            os.replace(tmp_path, cache_path)
+            logger.info(f"Модель сохранена в кэш: {cache_path}")
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить модель в кэш: {e}")
+    
     def _prepare_context(self, chunks: List[Dict[str, Any]]) -> str:
         """
         Подготовка контекста для генерации ответа
@@ -156,13 +387,12 @@ class LegalAnswerGenerator:
         used_chunks = chunks[:min(len(chunks), self.max_chunks)]
         
         # Формируем контекст, включая ссылки на источники
-        context = "Информация из правовых источников:\n\n"
-        
-        for i, chunk in enumerate(used_chunks):
-            context += f"[Документ {i+1}] {chunk['reference']}\n"
-            context += f"{chunk['chunk']}\n\n"
+        parts = [
+            f"[Документ {i+1}] {chunk['reference']}\n{chunk['chunk']}\n\n"
+            for i, chunk in enumerate(used_chunks)
+        ]
         
-        return context
+        return "Информация из правовых источников:\n\n" + "".join(parts)
     
     def _prepare_system_prompt(self) -> str:
         """
@@ -186,6 +416,78 @@ class LegalAnswerGenerator:
 
 Ты должен отвечать на русском языке, даже если вопрос задан на другом языке."""
     
+    def _prepare_prompt_prefix(self, system_prompt: str) -> List[Dict[str, str]]:
+        """
+        Подготовка неизменной начальной части диалога (системный промпт и ответ ассистента)
+        
+        Args:
+            system_prompt: системный промпт
+            
+        Returns:
+            Список из двух начальных сообщений
+        """
+        return [
+            {"role": "user", "content": system_prompt},
+            {"role": "assistant", "content": "Я готов помочь с юридическими вопросами по российскому законодательству."}
+        ]
+    
+    def _initialize_system_prefix(self):
+        """
+        Однократная подготовка текста и токенов неизменной начальной части диалога,
+        общей для всех запросов всех пользователей
+        """
+        prefix_messages = self._prepare_prompt_prefix(self._prepare_system_prompt())
+        self._system_prefix_text = self.tokenizer.apply_chat_template(prefix_messages, tokenize=False)
+        self._system_prefix_ids = self.tokenizer(
+            self._system_prefix_text,
+            add_special_tokens=False,
+            return_tensors="pt"
+        ).input_ids[0]
+    
+    def _tokenize_messages(self, messages: List[Dict[str, str]]) -> torch.Tensor:
+        """
+        Токенизация сообщений чата с переиспользованием токенов системного промпта
+        
+        Шаблон чата применяется ко всему диалогу, но токенизируется только часть
+        после неизменного префикса, которая затем присоединяется к готовым токенам.
+        
+        Args:
+            messages: список сообщений для модели
+            
+        Returns:
+            Тензор токенов формы (seq_len,)
+        """
+        text = self.tokenizer.apply_chat_template(messages, tokenize=False)
+        
+        if not text.startswith(self._system_prefix_text):
+            # Шаблон изменил начало диалога - токенизируем целиком
+            return self.tokenizer(text, add_special_tokens=False, return_tensors="pt").input_ids[0]
+        
+        delta_ids = self.tokenizer(
+            text[len(self._system_prefix_text):],
+            add_special_tokens=False,
+            return_tensors="pt"
+        ).input_ids[0]
+        return torch.cat([self._system_prefix_ids, delta_ids])
+    
+    def _initialize_system_prefix_cache(self):
+        """
+        Однократный расчет KV-кэша для неизменной начальной части диалога,
+        общей для всех запросов всех пользователей
+        """
+        # Явный динамический кэш: кэш по умолчанию (например, HybridCache у Gemma-3) имеет размер
+        # ровно по префиксу и не вмещает более длинный запрос
+        past_key_values = DynamicCache()
+        with torch.inference_mode():
+            outputs = self.model(
+                self._system_prefix_ids.unsqueeze(0).to(self.device),
+                past_key_values=past_key_values,
+                use_cache=True
+            )
+        self._system_prefix_kv = outputs.past_key_values
+        
+        logger.info(f"KV-кэш системного промпта рассчитан: {self._system_prefix_ids.shape[0]} токенов")
+    
     def _format_chat_messages(self, system_prompt: str, conversation_history: List[Dict[str, str]], user_query: str, context: str) -> List[Dict[str, str]]:
         """
         Форматирование сообщений для чата
@@ -200,15 +502,14 @@ class LegalAnswerGenerator:
             Список сообщений для модели
         """
         # Начинаем с системного сообщения
-        messages = [{"role": "user", "content": system_prompt}, {"role": "assistant", "content": "Я готов помочь с юридическими вопросами по российскому законодательству."}]
+        messages = self._prepare_prompt_prefix(system_prompt)
         
-        # Добавляем историю разговора
-        for message in conversation_history:
-            # Проверка чередования ролей
-            if messages[-1]["role"] == message["role"]:
-                logger.warning(f"Нарушение чередования ролей. Пропуск сообщения: {message}")
-                continue
-            messages.append(message)
+        # Добавляем историю разговора (чередование ролей в ней обеспечивает ConversationMemory).
+        # Если история после вытеснения старых сообщений начинается с ответа ассистента,
+        # он пропускается, так как префикс уже заканчивается репликой ассистента
+        if conversation_history and conversation_history[0]["role"] == messages[-1]["role"]:
+            conversation_history = conversation_history[1:]
+        messages.extend(conversation_history)
         
         # Инструкция по использованию контекста и запрос пользователя
         context_message = f"""Используй следующую информацию из российских правовых источников для ответа на вопрос.
@@ -227,14 +528,77 @@ class LegalAnswerGenerator:
         
         return messages
     
-    def generate_answer(
+    def _get_sampling_kwargs(self) -> Dict[str, Any]:
+        """
+        Параметры выбора следующего токена для generate()
+        
+        Returns:
+            Параметры сэмплирования или жадного декодирования
+        """
+        if self.sampling:
+            return {"do_sample": True, "temperature": self.temperature, "top_p": self.top_p}
+        
+        # Жадное декодирование: argmax вместо сортировки top_p и сэмплирования на каждом шаге,
+        # ответы на одинаковый запрос совпадают
+        return {"do_sample": False, "num_beams": 1}
+    
+    def _pad_batch(
+        self,
+        input_ids_list: List[torch.Tensor],
+        use_buckets: bool = False
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Объединение запросов в батч с дополнением слева до общей длины
+        
+        Args:
+            input_ids_list: список тензоров токенов формы (seq_len,)
+            use_buckets: округлять ли длину вверх до ближайшей фиксированной, чтобы
+                         статический KV-кэш не перекомпилировался на каждой новой длине
+            
+        Returns:
+            Кортеж (input_ids, attention_mask) формы (batch_size, target_len)
+        """
+        target_len = max(ids.shape[0] for ids in input_ids_list)
+        if use_buckets:
+            target_len = next((bucket for bucket in PROMPT_LENGTH_BUCKETS if bucket >= target_len), target_len)
+        
+        pad_token_id = self.tokenizer.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = self.tokenizer.eos_token_id
+        
+        input_ids = torch.full((len(input_ids_list), target_len), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(input_ids_list), target_len), dtype=torch.long)
+        for i, ids in enumerate(input_ids_list):
+            input_ids[i, target_len - ids.shape[0]:] = ids
+            attention_mask[i, target_len - ids.shape[0]:] = 1
+        
+        return self._to_device(input_ids), self._to_device(attention_mask)
+    
+    def _to_device(self, tensor: torch.Tensor) -> torch.Tensor:
+        """
+        Перенос тензора на устройство модели
+        
+        На GPU тензор копируется через закрепленную (pinned) память асинхронно,
+        без синхронизации CPU с GPU; generate() ставит свои ядра в тот же поток CUDA.
+        
+        Args:
+            tensor: тензор в памяти CPU
+            
+        Returns:
+            Тензор на устройстве модели
+        """
+        if self.device.type != "cuda":
+            return tensor
+        return tensor.pin_memory().to(self.device, non_blocking=True)
+    
+    def _build_messages(
         self,
         user_query: str,
         retrieved_chunks: List[Dict[str, Any]],
         conversation_memory: ConversationMemory
-    ) -> str:
+    ) -> List[Dict[str, str]]:
         """
-        Генерация ответа на юридический вопрос
+        Подготовка сообщений чата для одного запроса
         
         Args:
             user_query: запрос пользователя
@@ -242,59 +606,136 @@ class LegalAnswerGenerator:
             conversation_memory: объект для хранения истории разговора
             
         Returns:
-            Ответ на вопрос
+            Список сообщений для модели
         """
-        try:
-            # Подготовка данных для модели
-            system_prompt = self._prepare_system_prompt()
-            context = self._prepare_context(retrieved_chunks)
-            conversation_history = conversation_memory.get_history()
+        system_prompt = self._prepare_system_prompt()
+        context = self._prepare_context(retrieved_chunks)
+        conversation_history = conversation_memory.get_history()
+        
+        return self._format_chat_messages(
+            system_prompt=system_prompt,
+            conversation_history=conversation_history,
+            user_query=user_query,
+            context=context
+        )
+    
+    def _generate_padded(
+        self,
+        input_ids_list: List[torch.Tensor],
+        stopping_criteria: Optional[StoppingCriteriaList] = None
+    ) -> List[str]:
+        """
+        Генерация ответов для батча запросов с дополнением до общей длины
+        
+        Args:
+            input_ids_list: список тензоров токенов формы (seq_len,)
+            stopping_criteria: дополнительные критерии остановки генерации
             
-            # Форматирование сообщений для чата
-            messages = self._format_chat_messages(
-                system_prompt=system_prompt,
-                conversation_history=conversation_history,
-                user_query=user_query,
-                context=context
-            )
+        Returns:
+            Список декодированных ответов
+        """
+        generation_kwargs = {}
+        if self.draft_model is not None and len(input_ids_list) == 1:
+            # Спекулятивное декодирование: черновая модель предлагает несколько токенов,
+            # основная проверяет их за один прямой проход (поддерживается только для одного запроса)
+            generation_kwargs["assistant_model"] = self.draft_model
+            generation_kwargs["num_assistant_tokens"] = self.num_assistant_tokens
+        elif self.device.type == "cuda" and not self.compile_model:
+            # Статический кэш позволяет generate() скомпилировать шаг декодирования
+            # (если модель уже скомпилирована вручную, повторная компиляция не нужна)
+            generation_kwargs["cache_implementation"] = "static"
+        
+        # Дополнение до фиксированной длины нужно только статическому кэшу
+        model_inputs, attention_mask = self._pad_batch(
+            input_ids_list,
+            use_buckets=generation_kwargs.get("cache_implementation") == "static"
+        )
+        
+        if stopping_criteria is not None:
+            generation_kwargs["stopping_criteria"] = stopping_criteria
+        
+        # Запуск генерации
+        response_ids = self.model.generate(
+            model_inputs,
+            attention_mask=attention_mask,
+            max_new_tokens=self.max_tokens,
+            **self._get_sampling_kwargs(),
+            pad_token_id=self.tokenizer.eos_token_id,
+            use_cache=True,
+            **generation_kwargs
+        )
+        
+        # Декодирование результатов
+        return self.tokenizer.batch_decode(
+            response_ids[:, model_inputs.shape[1]:],
+            skip_special_tokens=True
+        )
+    
+    def _generate_with_prefix_cache(self, input_ids: torch.Tensor) -> str:
+        """
+        Генерация ответа с переиспользованием общего KV-кэша системного промпта
+        
+        Повторно обрабатываются только токены после системного промпта. KV-кэш
+        разговора между репликами не сохраняется: последняя реплика пользователя
+        в промпте содержит найденные документы, а в истории хранится только вопрос,
+        поэтому следующий промпт совпадает с предыдущим лишь до системного префикса.
+        
+        Args:
+            input_ids: тензор токенов запроса формы (seq_len,)
             
-            # Генерация ответа
-            logger.info(f"Генерация ответа на запрос: '{user_query}'")
+        Returns:
+            Декодированный ответ
+        """
+        prefix_ids = self._system_prefix_ids
+        if (
+            self._system_prefix_kv is None
+            or prefix_ids.shape[0] >= input_ids.shape[0]
+            or not torch.equal(input_ids[:prefix_ids.shape[0]], prefix_ids)
+        ):
+            return self._generate_padded([input_ids])[0]
+        
+        logger.info(f"Используется KV-кэш системного промпта: {prefix_ids.shape[0]} из {input_ids.shape[0]} токенов")
+        input_ids = self._to_device(input_ids)
+        
+        output = self.model.generate(
+            input_ids.unsqueeze(0),
+            attention_mask=torch.ones_like(input_ids).unsqueeze(0),
+            # Копия общего кэша: generate дописывает в кэш токены запроса и ответа
+            past_key_values=copy.deepcopy(self._system_prefix_kv),
+            cache_implementation=None,
+            max_new_tokens=self.max_tokens,
+            **self._get_sampling_kwargs(),
+            pad_token_id=self.tokenizer.eos_token_id,
+            use_cache=True
+        )
+        
+        return self.tokenizer.decode(output[0, input_ids.shape[0]:], skip_special_tokens=True)
+    
+    def generate_batch(
+        self,
+        requests: List[Tuple[str, List[Dict[str, Any]], ConversationMemory]]
+    ) -> List[str]:
+        """
+        Генерация ответов на несколько вопросов одним вызовом модели
+        
+        Args:
+            requests: список кортежей (запрос пользователя, релевантные чанки, история разговора)
             
+        Returns:
+            Список ответов в том же порядке
+        """
+        try:
             # Преобразование сообщений в формат, понятный модели
-            model_inputs = self.tokenizer.apply_chat_template(
-                messages,
-                tokenize=True,
-                return_tensors="pt"
-            ).to(self.device)
+            input_ids_list = []
+            for user_query, retrieved_chunks, conversation_memory in requests:
+                logger.info(f"Генерация ответа на запрос: '{user_query}'")
+                messages = self._build_messages(user_query, retrieved_chunks, conversation_memory)
+                input_ids_list.append(self._tokenize_messages(messages))
             
-            # Запуск генерации
-            response_ids = self.model.generate(
-                model_inputs,
-                max_new_tokens=self.max_tokens,
-                temperature=self.temperature,
-                top_p=self.top_p,
-                do_sample=True,
-                pad_token_id=self.tokenizer.eos_token_id
-            )
-            
-            # Декодирование результата
-            response = self.tokenizer.decode(
-                response_ids[0][model_inputs.shape[1]:],
-                skip_special_tokens=True
-            )
-            
-            # Если ответ содержит только пробельные символы или слишком короткий
-            if not response.strip() or len(response.strip()) < 10:
-                logger.warning("Получен пустой или слишком короткий ответ, генерация запасного ответа")
-                response = "К сожалению, не удалось сформировать ответ на основе имеющейся информации. Рекомендую обратиться к профессиональному юристу для получения квалифицированной консультации по этому вопросу."
-            
-            # Добавляем вопрос пользователя и ответ в историю
-            conversation_memory.add_message("user", user_query)
-            conversation_memory.add_message("assistant", response)
-            
-            logger.info("Ответ сгенерирован успешно")
-            return response
+            if self.prefix_cache and self.draft_model is None and len(requests) == 1:
+                responses = [self._generate_with_prefix_cache(input_ids_list[0])]
+            else:
+                responses = self._generate_padded(input_ids_list)
             
         except Exception as e:
             logger.error(f"Ошибка при генерации ответа: {e}")
@@ -303,10 +744,126 @@ class LegalAnswerGenerator:
             
             # В случае ошибки возвращаем стандартный ответ
             error_response = "Извините, произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте переформулировать вопрос или задать его позже."
-            conversation_memory.add_message("user", user_query)
-            conversation_memory.add_message("assistant", error_response)
+            responses = [error_response] * len(requests)
+        
+        answers = [
+            self._finalize_answer(user_query, response, conversation_memory)
+            for (user_query, _, conversation_memory), response in zip(requests, responses)
+        ]
+        
+        logger.info(f"Сгенерировано ответов: {len(answers)}")
+        return answers
+    
+    def _finalize_answer(self, user_query: str, response: str, conversation_memory: ConversationMemory) -> str:
+        """
+        Замена пустого ответа запасным и сохранение реплик в историю разговора
+        
+        Args:
+            user_query: запрос пользователя
+            response: сгенерированный ответ
+            conversation_memory: история разговора пользователя
+            
+        Returns:
+            Итоговый ответ
+        """
+        # Если ответ содержит только пробельные символы или слишком короткий
+        if not response.strip() or len(response.strip()) < 10:
+            logger.warning("Получен пустой или слишком короткий ответ, генерация запасного ответа")
+            response = "К сожалению, не удалось сформировать ответ на основе имеющейся информации. Рекомендую обратиться к профессиональному юристу для получения квалифицированной консультации по этому вопросу."
+        
+        # Добавляем вопрос пользователя и ответ в историю
+        conversation_memory.add_message("user", user_query)
+        conversation_memory.add_message("assistant", response)
+        return response
+    
+    def generate_answer_stream(
+        self,
+        user_query: str,
+        retrieved_chunks: List[Dict[str, Any]],
+        conversation_memory: ConversationMemory,
+        stop_event: Optional[threading.Event] = None
+    ) -> Iterator[str]:
+        """
+        Потоковая генерация ответа: модель работает в отдельном потоке,
+        а текст возвращается по мере появления новых токенов
+        
+        Последнее возвращенное значение - итоговый ответ. Если генерация прервана
+        через stop_event, последним возвращается None, а история разговора не изменяется.
+        
+        Args:
+            user_query: запрос пользователя
+            retrieved_chunks: релевантные чанки из индекса
+            conversation_memory: объект для хранения истории разговора
+            stop_event: событие для досрочной остановки генерации
+            
+        Yields:
+            Текст ответа, сгенерированный к текущему моменту (None - генерация остановлена)
+        """
+        logger.info(f"Потоковая генерация ответа на запрос: '{user_query}'")
+        stop_event = stop_event or threading.Event()
+        
+        messages = self._build_messages(user_query, retrieved_chunks, conversation_memory)
+        input_ids = self._to_device(self._tokenize_messages(messages).unsqueeze(0))
+        
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        errors = []
+        
+        def run_generation():
+            try:
+                self.model.generate(
+                    input_ids,
+                    attention_mask=torch.ones_like(input_ids),
+                    max_new_tokens=self.max_tokens,
+                    **self._get_sampling_kwargs(),
+                    pad_token_id=self.tokenizer.eos_token_id,
+                    use_cache=True,
+                    streamer=streamer,
+                    stopping_criteria=StoppingCriteriaList([StopOnEvent(stop_event)])
+                )
+            except Exception as e:
+                errors.append(e)
+                # Завершаем поток токенов, чтобы потребитель не ждал бесконечно
+                streamer.end()
+        
+        thread = threading.Thread(target=run_generation, daemon=True)
+        thread.start()
+        
+        response = ""
+        for text in streamer:
+            response += text
+            yield response
+        thread.join()
+        
+        if errors:
+            logger.error(f"Ошибка при потоковой генерации ответа: {errors[0]}")
+            yield "Извините, произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте переформулировать вопрос или задать его позже."
+            return
+        
+        if stop_event.is_set():
+            logger.info("Генерация ответа остановлена пользователем")
+            yield None
+            return
+        
+        yield self._finalize_answer(user_query, response, conversation_memory)
+    
+    def generate_answer(
+        self,
+        user_query: str,
+        retrieved_chunks: List[Dict[str, Any]],
+        conversation_memory: ConversationMemory
+    ) -> str:
+        """
+        Генерация ответа на юридический вопрос
+        
+        Args:
+            user_query: запрос пользователя
+            retrieved_chunks: релевантные чанки из индекса
+            conversation_memory: объект для хранения истории разговора
             
-            return error_response
+        Returns:
+            Ответ на вопрос
+        """
+        return self.generate_batch([(user_query, retrieved_chunks, conversation_memory)])[0]
     
     def is_legal_answer(self, query: str, response: str) -> bool:
         """
@@ -320,36 +877,20 @@ class LegalAnswerGenerator:
             True, если ответ адекватный для юридического вопроса
         """
         # Проверяем минимальную длину ответа
-        if len(response.split()) < 15:
+        word_count = len(response.split())
+        if word_count < 15:
             logger.warning(f"Ответ слишком короткий: '{response}'")
             return False
         
-        # Проверяем наличие отказа отвечать
-        refusal_phrases = [
-            "не могу дать юридическую консультацию",
-            "не могу предоставить юридическую консультацию",
-            "я не юрист",
-            "не могу дать профессиональный совет",
-            "обратитесь к юристу",
-            "я не могу комментировать",
-            "не относится к юридической тематике",
-            "не в моей компетенции"
-        ]
+        lowered = response.lower()
         
-        for phrase in refusal_phrases:
-            if phrase in response.lower() and len(response.split()) < 50:
-                logger.warning(f"Ответ содержит отказ: '{response}'")
-                return False
+        # Проверяем наличие отказа отвечать
+        if word_count < 50 and self._refusal_re.search(lowered):
+            logger.warning(f"Ответ содержит отказ: '{response}'")
+            return False
         
         # Проверка наличия юридической терминологии в ответе
-        legal_terms = [
-            "закон", "право", "статья", "кодекс", "законодательств",
-            "норматив", "постановлен", "суд", "юридическ", "правоотношен",
-            "федеральн", "нормативно-правов"
-        ]
-        
-        has_legal_terms = any(term in response.lower() for term in legal_terms)
-        if not has_legal_terms:
+        if not self._legal_terms_re.search(lowered):
             logger.warning(f"Ответ не содержит юридической терминологии: '{response}'")
             return False
         
@@ -370,20 +911,14 @@ class LegalAnswerGenerator:
         if not context_documents or len(context_documents) == 0:
             return answer
         
-        # Добавляем источники
-        sources_text = "\n\n📚 Источники информации:\n"
-        added_refs = set()  # Для отслеживания уникальных источников
-        
-        for i, doc in enumerate(context_documents):
-            if "reference" in doc and doc["reference"]:
-                ref = doc["reference"].strip()
-                # Добавляем только уникальные источники
-                if ref not in added_refs:
-                    sources_text += f"{i+1}. {ref}\n"
-                    added_refs.add(ref)
+        # Уникальные источники в порядке появления
+        unique_refs = list(dict.fromkeys(
+            doc["reference"].strip() for doc in context_documents if doc.get("reference")
+        ))
         
         # Возвращаем ответ с источниками, если есть уникальные источники
-        if len(added_refs) > 0:
-            return f"{answer}\n{sources_text}"
-        else:
-            return answer 
\ No newline at end of file
+        if not unique_refs:
+            return answer
+        
+        sources_text = "\n".join(f"{i}. {ref}" for i, ref in enumerate(unique_refs, 1))
+        return f"{answer}\n\n\n📚 Источники информации:\n{sources_text}\n"
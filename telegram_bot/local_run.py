@@ -73,14 +73,45 @@ def main():
                 telegram_token=telegram_token,
                 index_path=index_path,
                 chunks_data_path=chunks_data_path,
+                llm_model_name=os.getenv("LLM_MODEL", "google/gemma-3-4b-it"),
                 huggingface_token=huggingface_token,
                 max_history=int(os.getenv("MAX_HISTORY", "8")),
                 max_chunks=int(os.getenv("MAX_CHUNKS", "5")),
                 max_tokens=int(os.getenv("MAX_TOKENS", "1024")),
                 temperature=float(os.getenv("TEMPERATURE", "0.7")),
-                top_p=float(os.getenv("TOP_P", "0.9"))
+                top_p=float(os.getenv("TOP_P", "0.9")),
+                faiss_mmap=os.getenv("FAISS_MMAP", "0") == "1",
+                low_memory=os.getenv("FAISS_LOW_MEMORY", "1") == "1",
+                model_cache_dir=os.getenv("MODEL_CACHE_DIR"),
+                quantization=os.getenv("QUANTIZATION", "int8"),
+                redis_url=os.getenv("REDIS_URL"),
+                response_cache_ttl=int(os.getenv("RESPONSE_CACHE_TTL", "3600")),
+                conversation_ttl=int(os.getenv("CONVERSATION_TTL", "86400")),
+                generation_batch_size=int(os.getenv("GENERATION_BATCH_SIZE", "8")),
+                generation_batch_window=float(os.getenv("GENERATION_BATCH_WINDOW", "0.01")),
+                search_batch_size=int(os.getenv("SEARCH_BATCH_SIZE", "32")),
+                search_batch_window=float(os.getenv("SEARCH_BATCH_WINDOW", "0.01")),
+                prefix_cache=os.getenv("PREFIX_KV_CACHE", "0") == "1",
+                max_users_in_memory=int(os.getenv("MAX_USERS_IN_MEM", "10000")),
+                nprobe=int(os.getenv("NPROBE", "16")),
+                index_factory=os.getenv("INDEX_FACTORY") or None,
+                index_factory_min_vectors=int(os.getenv("INDEX_FACTORY_MIN_VECTORS", "50000")),
+                faiss_gpu=os.getenv("FAISS_GPU") == "1" if os.getenv("FAISS_GPU") else None,
+                embedding_onnx_dir=os.getenv("EMBEDDING_ONNX_DIR") or None,
+                embedding_onnx_int8=os.getenv("EMBEDDING_ONNX_INT8", "0") == "1",
+                compile_embedding_model=os.getenv("COMPILE_EMBEDDING_MODEL", "0") == "1",
+                compile_model=os.getenv("COMPILE_MODEL", "0") == "1",
+                attn_implementation=os.getenv("ATTN_IMPLEMENTATION") or None,
+                draft_model=os.getenv("DRAFT_MODEL") or None,
+                num_assistant_tokens=int(os.getenv("NUM_ASSISTANT_TOKENS", "5")),
+                stream_responses=os.getenv("STREAM_RESPONSES", "0") == "1",
+                stream_edit_interval=float(os.getenv("STREAM_EDIT_INTERVAL", "1.0")),
+                max_concurrent_streams=int(os.getenv("MAX_CONCURRENT_STREAMS", "2")),
+                semantic_cache=os.getenv("SEMANTIC_CACHE", "0") == "1",
+                semantic_cache_threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95")),
+                sampling=os.getenv("SAMPLING", "0") == "1"
             )
-            await bot.run()
+            await bot.run_async()
         
         # Запуск асинхронной функции
         asyncio.run(run_bot())
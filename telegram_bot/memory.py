@@ -1,94 +1,94 @@
-from collections import defaultdict, deque
+from collections import deque
+from typing import Dict, List, Optional
 
 class ConversationMemory:
-    """Класс для хранения истории сообщений пользователей"""
+    """
+    Класс для управления историей разговора
+    """
     
-    def __init__(self, max_messages=10):
+    def __init__(self, max_history: int = 8):
         """
-        Инициализация памяти разговоров
+        Инициализация памяти разговора
         
         Args:
-            max_messages: максимальное количество сообщений для хранения на пользователя
+            max_history: максимальное количество последних сообщений для хранения
         """
-        self.max_messages = max_messages
-        # Используем defaultdict(deque) для эффективного хранения истории сообщений
-        self.memory = defaultdict(lambda: deque(maxlen=max_messages))
+        # deque с maxlen сам вытесняет старые сообщения без копирования списка
+        self.messages = deque(maxlen=max_history)
+        self.max_history = max_history
+        
+        # Количество сообщений, добавленных после последнего сохранения во внешнее хранилище
+        self.unsaved_messages = 0
+        # Изменено ли последнее уже сохраненное сообщение (к нему присоединено новое той же роли)
+        self.tail_modified = False
     
-    def add_message(self, user_id, role, text):
+    def add_message(self, role: str, content: str):
         """
         Добавление сообщения в историю
         
         Args:
-            user_id: идентификатор пользователя
-            role: роль ('user' или 'assistant')
-            text: текст сообщения
+            role: роль отправителя (user или assistant)
+            content: содержание сообщения
         """
-        self.memory[user_id].append({
-            "role": role,
-            "content": [{"type": "text", "text": text}]
-        })
+        # Проверка валидности роли
+        if role not in ["user", "assistant"]:
+            raise ValueError(f"Недопустимая роль: {role}. Используйте 'user' или 'assistant'")
+        
+        # Роли в истории чередуются: подряд идущие сообщения одной роли объединяются
+        if self.messages and self.messages[-1]["role"] == role:
+            self.messages[-1]["content"] += f"\n{content}"
+            if self.unsaved_messages == 0:
+                self.tail_modified = True
+            return
+        
+        # Добавление сообщения
+        self.messages.append({"role": role, "content": content})
+        self.unsaved_messages = min(self.unsaved_messages + 1, self.max_history)
     
-    def get_conversation_history(self, user_id):
+    def get_history(self) -> List[Dict[str, str]]:
         """
-        Получение истории разговора для пользователя
+        Получение истории разговора
         
-        Args:
-            user_id: идентификатор пользователя
-            
         Returns:
-            Список сообщений в формате, готовом для использования с моделью
+            Список сообщений в формате [{"role": role, "content": content}, ...]
+        """
+        return list(self.messages)
+    
+    def clear(self):
+        """
+        Очистка истории разговора
         """
-        return list(self.memory[user_id])
+        self.messages.clear()
+        self.unsaved_messages = 0
+        self.tail_modified = False
     
-    def get_last_n_messages(self, user_id, n=None):
+    def get_last_n_messages(self, n: Optional[int] = None) -> List[Dict[str, str]]:
         """
-        Получение последних N сообщений для пользователя
+        Получение последних N сообщений
         
         Args:
-            user_id: идентификатор пользователя
             n: количество сообщений (если None, возвращает все сохраненные)
             
         Returns:
             Список последних N сообщений
         """
-        if n is None:
-            return list(self.memory[user_id])
+        if n is None or len(self.messages) <= n:
+            return list(self.messages)
         
-        history = self.memory[user_id]
-        if len(history) <= n:
-            return list(history)
-        
-        return list(history)[-n:]
+        return list(self.messages)[-n:]
     
-    def clear_history(self, user_id):
-        """
-        Очистка истории для пользователя
-        
-        Args:
-            user_id: идентификатор пользователя
-        """
-        if user_id in self.memory:
-            self.memory[user_id].clear()
-    
-    def get_formatted_history(self, user_id, n=None):
+    def get_formatted_history(self, n: Optional[int] = None) -> str:
         """
         Получение форматированной истории для отладки
         
         Args:
-            user_id: идентификатор пользователя
             n: количество сообщений (если None, возвращает все сохраненные)
             
         Returns:
             Строка с форматированной историей
         """
-        messages = self.get_last_n_messages(user_id, n)
+        messages = self.get_last_n_messages(n)
         if not messages:
             return "История сообщений пуста"
         
-        formatted = []
-        for msg in messages:
-            role = msg["role"]
-            text = msg["content"][0]["text"] if isinstance(msg["content"], list) else msg["content"]
-            formatted.append(f"[{role.upper()}]: {text}")
-        
-        return "\n".join(formatted) 
\ No newline at end of file
+        return "\n".join(f"[{msg['role'].upper()}]: {msg['content']}" for msg in messages)
@@ -6,13 +6,31 @@
 """
 
 import os
+import re
+import mmap
 import pickle
+import hashlib
+import threading
 import faiss
 import torch
 import numpy as np
+from cachetools import LRUCache
 from typing import List, Dict, Any, Tuple, Optional
 from transformers import AutoTokenizer, AutoModel
 
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+except ImportError:
+    pa = None
+
+try:
+    import onnxruntime as ort
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+except ImportError:
+    ort = None
+
 # Настройка логирования
 import logging
 logging.basicConfig(
@@ -21,18 +39,137 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Загруженные модели эмбеддингов, общие для всех экземпляров LegalRetriever в процессе:
+# ключ - (модель, устройство, каталог ONNX, INT8, torch.compile),
+# значение - (токенизатор, модель, блокировка прямого прохода модели)
+_EMBEDDING_MODELS: Dict[Tuple[str, str, Optional[str], bool, bool], Tuple[Any, Any, threading.Lock]] = {}
+_EMBEDDING_MODELS_LOCK = threading.Lock()
+
+def compile_trie_pattern(words) -> "re.Pattern":
+    """
+    Компиляция набора слов в регулярное выражение в виде префиксного дерева
+    
+    Общие префиксы слов проверяются один раз (как в автомате Ахо-Корасик), поэтому
+    поиск не перебирает все альтернативы в каждой позиции текста. Выражение
+    предназначено для проверки наличия любого слова: если слово является префиксом
+    другого, более длинное слово не добавляется.
+    
+    Args:
+        words: искомые слова и фразы
+        
+    Returns:
+        Скомпилированное регулярное выражение
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+    
+    def to_pattern(node) -> str:
+        # Слово закончилось - продолжение для проверки наличия не нужно
+        if "" in node:
+            return ""
+        alternatives = [re.escape(char) + to_pattern(child) for char, child in sorted(node.items())]
+        if len(alternatives) == 1:
+            return alternatives[0]
+        return "(?:" + "|".join(alternatives) + ")"
+    
+    return re.compile(to_pattern(trie))
+
+
+class ArrowColumn:
+    """
+    Обертка над строковой колонкой Arrow с доступом по индексу, как у списка.
+    Данные остаются в отображенном в память файле, строки создаются только при обращении.
+    """
+    
+    def __init__(self, column):
+        """
+        Args:
+            column: колонка pyarrow.ChunkedArray
+        """
+        self.column = column
+    
+    def __len__(self) -> int:
+        return len(self.column)
+    
+    def __getitem__(self, idx: int) -> str:
+        return self.column[idx].as_py()
+
+
 class LegalRetriever:
     """
     Класс для поиска релевантных юридических документов по запросу
     """
     
+    # Ключевые слова юридической тематики
+    LEGAL_KEYWORDS = (
+        "закон", "право", "юрид", "кодекс", "статья", "суд", "догов", "норм",
+        "ответств", "регул", "легал", "законодат", "обязан", "регистрац",
+        "защит", "патент", "лиценз", "штраф", "санкц", "иск", "налог",
+        "имуществ", "наслед", "собствен", "возмещ", "компенс", "претенз",
+        "нотари", "адвокат", "доверен", "учред", "устав", "акционер", "директор"
+    )
+    
+    # Типичные формулировки вопросов о правах, обязанностях и т.д.
+    LEGAL_PATTERNS = (
+        "имею ли я право", "можно ли", "законно ли", "правомерно ли",
+        "как правильно", "какие права", "какие обязанности", "что делать если",
+        "как оформить", "как получить", "как подать", "как заполнить",
+        "как составить", "как зарегистрировать", "что говорит закон",
+        "что сказано в законе", "по закону", "согласно закону"
+    )
+    
+    # Юридические термины и фразы для расширения коротких запросов
+    QUERY_EXPANSIONS = (
+        "юридические аспекты",
+        "правовые нормы",
+        "законодательство",
+        "федеральный закон",
+        "права и обязанности",
+        "правовой статус",
+        "юридическое понятие",
+        "согласно закону",
+        "нормативно-правовой акт"
+    )
+    
+    # Фразы, не относящиеся к юридическим вопросам, которые удаляются из запроса
+    FILLER_PHRASES = (
+        "скажи мне",
+        "расскажи о",
+        "что такое",
+        "как понять",
+        "объясни",
+        "можешь ли ты",
+        "пожалуйста",
+        "подскажи"
+    )
+    
+    # Множества слов расширений и выражение для удаления фраз вычисляются один раз при импорте
+    _EXPANSION_WORDSETS = tuple((expansion, frozenset(expansion.lower().split())) for expansion in QUERY_EXPANSIONS)
+    _FILLER_RE = re.compile("|".join(map(re.escape, FILLER_PHRASES)))
+    
+    # Словарь юридических терминов, скомпилированный в одно выражение-префиксное дерево
+    _LEGAL_RE = compile_trie_pattern(LEGAL_KEYWORDS + LEGAL_PATTERNS)
+    
     def __init__(
         self,
         index_path: str,
         chunks_data_path: str,
         embedding_model: Optional[str] = None,
         use_query_expansion: bool = True,
-        top_k: int = 5
+        top_k: int = 5,
+        use_mmap: bool = False,
+        low_memory: bool = True,
+        nprobe: int = 16,
+        use_gpu: Optional[bool] = None,
+        onnx_dir: Optional[str] = None,
+        onnx_int8: bool = False,
+        index_factory: Optional[str] = None,
+        index_factory_min_vectors: int = 50000,
+        compile_model: bool = False
     ):
         """
         Инициализация ретривера
@@ -43,11 +180,33 @@ class LegalRetriever:
             embedding_model: название модели для эмбеддингов (если None, будет взято из файла с чанками)
             use_query_expansion: использовать ли расширение запроса
             top_k: количество топ результатов для возврата
+            use_mmap: загружать ли индекс через memory-map (только для индексов семейства IVF,
+                      хранящихся на локальном SSD)
+            low_memory: отключать ли предвычисленные таблицы IVFPQ для экономии памяти
+            nprobe: количество просматриваемых кластеров для индексов семейства IVF
+            use_gpu: переносить ли индекс на GPU (требуется сборка FAISS с поддержкой GPU);
+                     если None, индекс переносится при наличии GPU
+            onnx_dir: директория модели эмбеддингов в формате ONNX для запуска через ONNX Runtime
+                      на CPU (экспортируется при первом запуске); если None, используется PyTorch
+            onnx_int8: квантизовать ли веса ONNX-модели в INT8 (может снизить точность эмбеддингов)
+            index_factory: строка index_factory сжатого индекса (например, "OPQ16_64,IVF4096,PQ16"),
+                           в который перестраивается плоский индекс при загрузке; если None, не перестраивается
+            index_factory_min_vectors: минимальный размер плоского индекса для перестроения
+            compile_model: компилировать ли прямой проход модели эмбеддингов через torch.compile (только на GPU)
         """
         self.index_path = index_path
         self.chunks_data_path = chunks_data_path
         self.use_query_expansion = use_query_expansion
         self.top_k = top_k
+        self.use_mmap = use_mmap
+        self.low_memory = low_memory
+        self.nprobe = nprobe
+        self.use_gpu = use_gpu
+        self.onnx_dir = os.path.expanduser(onnx_dir) if onnx_dir else None
+        self.onnx_int8 = onnx_int8
+        self.index_factory = index_factory
+        self.index_factory_min_vectors = index_factory_min_vectors
+        self.compile_model = compile_model
         
         # Загрузка индекса и данных
         self._load_index_and_data()
@@ -69,82 +228,415 @@ class LegalRetriever:
         if not os.path.exists(self.chunks_data_path):
             raise FileNotFoundError(f"Файл с данными чанков не найден: {self.chunks_data_path}")
         
-        # Загрузка индекса
+        # Загрузка индекса (loaded_index_path - файл, который фактически читается и прогревается)
         try:
-            self.index = faiss.read_index(self.index_path)
+            compressed_path = self._get_compressed_index_path()
+            if (
+                compressed_path
+                and os.path.exists(compressed_path)
+                and os.path.getmtime(compressed_path) >= os.path.getmtime(self.index_path)
+            ):
+                # Сжатый индекс уже построен по текущему исходному индексу
+                logger.info(f"Загрузка сжатого индекса из {compressed_path}")
+                self.loaded_index_path = compressed_path
+                self.index = self._read_index(compressed_path)
+            else:
+                self.loaded_index_path = self.index_path
+                self.index = self._read_index(self.index_path)
+                
+                if (
+                    compressed_path
+                    and isinstance(self.index, faiss.IndexFlat)
+                    and self.index.ntotal >= self.index_factory_min_vectors
+                ):
+                    self.index = self._build_compressed_index(compressed_path)
             logger.info(f"Индекс успешно загружен, содержит {self.index.ntotal} векторов")
+            
+            # Настройка параметров для индексов семейства IVF (в том числе обернутых в OPQ)
+            try:
+                ivf_index = faiss.extract_index_ivf(self.index)
+            except RuntimeError:
+                ivf_index = None
+            
+            if ivf_index is not None:
+                ivf_index.nprobe = self.nprobe
+                logger.info(f"Индекс IVF: nlist={ivf_index.nlist}, nprobe={self.nprobe}")
+                
+                # Предвычисленная таблица IVFPQ может удваивать расход памяти
+                if self.low_memory and isinstance(ivf_index, faiss.IndexIVFPQ):
+                    ivf_index.use_precomputed_table = 0
+                    ivf_index.precomputed_table.resize(0)
+                    logger.info("Предвычисленная таблица IVFPQ отключена")
+            
+            if self.use_gpu or (self.use_gpu is None and self._faiss_gpu_available()):
+                self._move_index_to_gpu()
         except Exception as e:
             logger.error(f"Ошибка при загрузке индекса: {e}")
             raise
         
         # Загрузка данных чанков
         try:
-            with open(self.chunks_data_path, "rb") as f:
-                self.chunks_data = pickle.load(f)
-            
-            self.chunks = self.chunks_data["chunks"]
-            self.references = self.chunks_data["references"]
+            if self.chunks_data_path.endswith(".arrow"):
+                self._load_arrow_chunks()
+            else:
+                with open(self.chunks_data_path, "rb") as f:
+                    self.chunks_data = pickle.load(f)
+                
+                self.chunks = self.chunks_data["chunks"]
+                self.references = self.chunks_data["references"]
             
             logger.info(f"Данные чанков успешно загружены, {len(self.chunks)} чанков")
         except Exception as e:
             logger.error(f"Ошибка при загрузке данных чанков: {e}")
             raise
     
+    def _read_index(self, path: str) -> faiss.Index:
+        """
+        Чтение индекса FAISS с диска
+        
+        Args:
+            path: путь к файлу индекса
+            
+        Returns:
+            Индекс FAISS
+        """
+        if self.use_mmap:
+            # Индекс отображается в память и не копируется в RAM целиком
+            return faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        return faiss.read_index(path)
+    
+    def _get_compressed_index_path(self) -> Optional[str]:
+        """
+        Получение пути к файлу сжатого индекса рядом с исходным
+        
+        Returns:
+            Путь к файлу или None, если перестроение индекса отключено
+        """
+        if not self.index_factory:
+            return None
+        
+        suffix = re.sub(r"[^0-9A-Za-z]+", "_", self.index_factory).strip("_")
+        return f"{os.path.splitext(self.index_path)[0]}.{suffix}.faiss"
+    
+    def _build_compressed_index(self, output_path: str) -> faiss.Index:
+        """
+        Перестроение плоского индекса в сжатый: векторы извлекаются из плоского индекса,
+        сжатый индекс обучается на них и сохраняется для следующих запусков
+        
+        Args:
+            output_path: путь для сохранения сжатого индекса
+            
+        Returns:
+            Сжатый индекс
+        """
+        logger.info(f"Перестроение индекса из {self.index.ntotal} векторов в {self.index_factory}...")
+        
+        vectors = self.index.reconstruct_n(0, self.index.ntotal)
+        
+        # Эмбеддинги E5 нормализованы, поэтому используется скалярное произведение
+        index = faiss.index_factory(self.index.d, self.index_factory, faiss.METRIC_INNER_PRODUCT)
+        index.train(vectors)
+        index.add(vectors)
+        
+        faiss.write_index(index, output_path)
+        logger.info(f"Сжатый индекс сохранен в {output_path}")
+        
+        return index
+    
+    @staticmethod
+    def _faiss_gpu_available() -> bool:
+        """
+        Проверка, собран ли FAISS с поддержкой GPU и доступен ли хотя бы один GPU
+        """
+        return hasattr(faiss, "StandardGpuResources") and faiss.get_num_gpus() > 0
+    
+    def _move_index_to_gpu(self):
+        """
+        Перенос индекса FAISS на GPU, если это поддерживается сборкой FAISS
+        """
+        if not self._faiss_gpu_available():
+            logger.warning("FAISS собран без поддержки GPU или GPU недоступен, индекс остается на CPU")
+            return
+        
+        # Таблицы поиска в float16 нужны для PQ-кодов длиной более 48 байт (например, IVF4096,PQ64)
+        cloner_options = faiss.GpuClonerOptions()
+        cloner_options.useFloat16 = True
+        
+        try:
+            # Ресурсы GPU должны жить столько же, сколько индекс
+            gpu_resources = faiss.StandardGpuResources()
+            self.index = faiss.index_cpu_to_gpu(gpu_resources, 0, self.index, cloner_options)
+        except Exception as e:
+            # Явно запрошенный перенос должен завершаться ошибкой, автоматический - нет
+            if self.use_gpu:
+                raise
+            logger.warning(f"Не удалось перенести индекс на GPU, индекс остается на CPU: {e}")
+            return
+        
+        self.gpu_resources = gpu_resources
+        logger.info("Индекс перенесен на GPU")
+    
+    def _load_arrow_chunks(self):
+        """
+        Загрузка чанков из файла Arrow IPC через memory-map без копирования текста в память процесса
+        """
+        if pa is None:
+            raise ImportError("Для загрузки чанков в формате Arrow необходим пакет pyarrow. Установите его: pip install pyarrow")
+        
+        # Подсказка ОС заранее прочитать файл в страничный кэш
+        if hasattr(os, "posix_fadvise"):
+            with open(self.chunks_data_path, "rb") as f:
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        
+        source = pa.memory_map(self.chunks_data_path, "r")
+        table = pa.ipc.open_file(source).read_all()
+        
+        metadata = table.schema.metadata or {}
+        self.chunks_data = {}
+        if b"embedder_model" in metadata:
+            self.chunks_data["embedder_model"] = metadata[b"embedder_model"].decode("utf-8")
+        
+        self.chunks = ArrowColumn(table.column("chunk"))
+        self.references = ArrowColumn(table.column("reference"))
+    
+    def prefault_index(self, chunk_size: int = 4 * 1024 * 1024):
+        """
+        Прогрев страничного кэша ОС для файла индекса
+        
+        Последовательно читает файл индекса, чтобы при memory-map загрузке
+        первый поиск не упирался в случайные page faults.
+        
+        Args:
+            chunk_size: размер блока чтения в байтах
+        """
+        logger.info(f"Прогрев страничного кэша для индекса {self.loaded_index_path}")
+        
+        try:
+            with open(self.loaded_index_path, "rb") as f:
+                fd = f.fileno()
+                
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+                
+                # Последовательное чтение заполняет кэш через readahead
+                while f.read(chunk_size):
+                    pass
+                
+                # На Linux дополнительно отображаем файл с MAP_POPULATE
+                if hasattr(mmap, "MAP_POPULATE") and os.fstat(fd).st_size > 0:
+                    mapped = mmap.mmap(fd, 0, flags=mmap.MAP_PRIVATE | mmap.MAP_POPULATE, prot=mmap.PROT_READ)
+                    mapped.close()
+            
+            logger.info("Страничный кэш для индекса прогрет")
+        except OSError as e:
+            logger.warning(f"Не удалось прогреть страничный кэш для индекса: {e}")
+    
     def _initialize_embedding_model(self):
         """
         Инициализация модели для создания эмбеддингов
         """
         logger.info(f"Инициализация модели эмбеддингов: {self.embedding_model}")
         
+        # Кэши эмбеддингов и расширений запросов создаются заново вместе с моделью
+        self._embedding_cache: LRUCache = LRUCache(maxsize=2048)
+        self._expansion_cache: LRUCache = LRUCache(maxsize=4096)
+        # Эмбеддинги строятся одновременно в нескольких рабочих потоках (поиск и семантический кэш)
+        self._cache_lock = threading.Lock()
+        
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        use_onnx = bool(self.onnx_dir) and self.device.type == "cpu"
+        use_compile = self.compile_model and self.device.type == "cuda"
+        model_key = (self.embedding_model, self.device.type, self.onnx_dir if use_onnx else None,
+                     use_onnx and self.onnx_int8, use_compile)
+        
         try:
-            self.tokenizer = AutoTokenizer.from_pretrained(self.embedding_model)
-            self.model = AutoModel.from_pretrained(self.embedding_model).to(self.device)
-            self.model.eval()
+            # Модель загружается один раз на процесс; остальные экземпляры используют те же веса
+            with _EMBEDDING_MODELS_LOCK:
+                if model_key in _EMBEDDING_MODELS:
+                    self.tokenizer, self.model, self._model_lock = _EMBEDDING_MODELS[model_key]
+                    logger.info(f"Используется ранее загруженная модель эмбеддингов на {self.device}")
+                    return
+                
+                # Прямые проходы общей модели из разных потоков выполняются по очереди
+                self._model_lock = threading.Lock()
+                self.tokenizer = AutoTokenizer.from_pretrained(self.embedding_model, use_fast=True)
+                if not self.tokenizer.is_fast:
+                    logger.warning("Быстрый токенизатор (Rust) недоступен для модели эмбеддингов, используется медленный")
+                if use_onnx:
+                    self.model = self._load_onnx_model()
+                else:
+                    # На GPU веса хранятся в float16: вдвое меньше чтений памяти без заметной потери точности.
+                    # На CPU остается float32 - без AMX вычисления в bfloat16 медленнее
+                    dtype = torch.float16 if self.device.type == "cuda" else torch.float32
+                    self.model = AutoModel.from_pretrained(self.embedding_model, torch_dtype=dtype).to(self.device)
+                    self.model.eval()
+                    if use_compile:
+                        self._compile_embedding_model()
+                
+                _EMBEDDING_MODELS[model_key] = (self.tokenizer, self.model, self._model_lock)
             logger.info(f"Модель эмбеддингов успешно загружена на {self.device}")
         except Exception as e:
             logger.error(f"Ошибка при инициализации модели эмбеддингов: {e}")
             raise
     
+    def _compile_embedding_model(self):
+        """
+        Компиляция прямого прохода модели эмбеддингов через torch.compile и прогрев,
+        чтобы первый запрос пользователя не ожидал компиляции
+        """
+        if not hasattr(torch, "compile"):
+            logger.warning("torch.compile недоступен (требуется torch>=2.2), модель эмбеддингов не компилируется")
+            return
+        
+        logger.info("Компиляция модели эмбеддингов через torch.compile...")
+        
+        # dynamic=True исключает перекомпиляцию на каждом размере батча и длине запроса
+        self.model.forward = torch.compile(self.model.forward, mode="reduce-overhead", fullgraph=False, dynamic=True)
+        
+        # Прогрев на одиночном запросе и на батче с дополнением
+        self._compute_embeddings(["прогрев"])
+        self._compute_embeddings(["прогрев", "прогрев модели эмбеддингов"])
+    
+    def _load_onnx_model(self):
+        """
+        Загрузка модели эмбеддингов в ONNX Runtime (при первом запуске модель
+        экспортируется в ONNX и сохраняется в onnx_dir)
+        
+        Returns:
+            Модель ONNX Runtime с тем же интерфейсом, что и модель transformers
+        """
+        if ort is None:
+            raise ImportError("Для запуска эмбеддингов через ONNX Runtime необходим пакет optimum[onnxruntime]. "
+                              "Установите его: pip install optimum[onnxruntime]")
+        
+        file_name = "model_quantized.onnx" if self.onnx_int8 else "model.onnx"
+        
+        if not os.path.exists(os.path.join(self.onnx_dir, "model.onnx")):
+            logger.info(f"Экспорт модели эмбеддингов в ONNX: {self.onnx_dir}")
+            ORTModelForFeatureExtraction.from_pretrained(self.embedding_model, export=True).save_pretrained(self.onnx_dir)
+        
+        if self.onnx_int8 and not os.path.exists(os.path.join(self.onnx_dir, file_name)):
+            # Динамическая квантизация весов в INT8 (без калибровочных данных)
+            logger.info("Квантизация модели эмбеддингов в INT8")
+            quantizer = ORTQuantizer.from_pretrained(self.onnx_dir, file_name="model.onnx")
+            quantizer.quantize(
+                save_dir=self.onnx_dir,
+                quantization_config=AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+            )
+        
+        # Все оптимизации графа: слияние операций внимания, LayerNorm и GELU
+        session_options = ort.SessionOptions()
+        session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        
+        logger.info(f"Модель эмбеддингов загружается в ONNX Runtime: {file_name}")
+        return ORTModelForFeatureExtraction.from_pretrained(
+            self.onnx_dir,
+            file_name=file_name,
+            provider="CPUExecutionProvider",
+            session_options=session_options
+        )
+    
     def _average_pool(self, last_hidden_states, attention_mask):
         """
         Усреднение токенов с учетом маски внимания
         """
-        last_hidden = last_hidden_states.masked_fill(~attention_mask[..., None].bool(), 0.0)
-        return last_hidden.sum(dim=1) / attention_mask.sum(dim=1)[..., None]
+        # Взвешенная маской сумма по токенам одним einsum, без промежуточной копии скрытых состояний
+        mask = attention_mask.to(last_hidden_states.dtype)
+        summed = torch.einsum("bth,bt->bh", last_hidden_states, mask)
+        return summed / mask.sum(dim=1, keepdim=True)
     
-    def _embed_query(self, query: str) -> np.ndarray:
+    def _embed_queries(self, queries: List[str]) -> np.ndarray:
         """
-        Создание эмбеддинга запроса
+        Создание эмбеддингов для нескольких запросов с кэшированием по тексту запроса
         
         Args:
-            query: текст запроса
+            queries: тексты запросов
+            
+        Returns:
+            Матрица эмбеддингов формы (len(queries), dim)
+        """
+        keys = [hashlib.blake2b(query.encode("utf-8"), digest_size=16).digest() for query in queries]
+        with self._cache_lock:
+            embeddings = [self._embedding_cache.get(key) for key in keys]
+        
+        # Одним проходом модели считаются только отсутствующие в кэше эмбеддинги
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            computed = self._compute_embeddings([queries[i] for i in missing])
+            with self._cache_lock:
+                for i, embedding in zip(missing, computed):
+                    embeddings[i] = embedding
+                    self._embedding_cache[keys[i]] = embedding
+        
+        return np.stack(embeddings)
+    
+    def _compute_embeddings(self, queries: List[str]) -> np.ndarray:
+        """
+        Создание эмбеддингов для нескольких запросов одним проходом модели
+        
+        Args:
+            queries: тексты запросов
             
         Returns:
-            Эмбеддинг запроса
+            Матрица эмбеддингов формы (len(queries), dim)
         """
-        # Подготовка запроса в формате, подходящем для модели (для E5)
-        processed_query = f"query: {query}"
+        # Подготовка запросов в формате, подходящем для модели (для E5)
+        processed_queries = [f"query: {query}" for query in queries]
         
-        # Токенизация
+        # Токенизация (выравнивание длины нужно только для нескольких запросов)
         inputs = self.tokenizer(
-            processed_query,
-            padding=True,
+            processed_queries,
+            padding=len(processed_queries) > 1,
             truncation=True,
             max_length=512,
             return_tensors="pt"
-        ).to(self.device)
+        )
+        if self.device.type == "cuda":
+            # Копирование через закрепленную память без синхронизации CPU с GPU;
+            # модель выполняется в том же потоке CUDA, поэтому порядок операций сохраняется
+            inputs = {key: value.pin_memory().to(self.device, non_blocking=True) for key, value in inputs.items()}
         
-        # Создание эмбеддинга
-        with torch.no_grad():
+        # Создание эмбеддингов
+        with self._model_lock, torch.inference_mode():
             outputs = self.model(**inputs)
-            embeddings = self._average_pool(outputs.last_hidden_state, inputs["attention_mask"])
+            # Усреднение и нормализация выполняются в float32, который ожидает FAISS
+            embeddings = self._average_pool(outputs.last_hidden_state.float(), inputs["attention_mask"])
             embeddings = torch.nn.functional.normalize(embeddings, p=2, dim=1)
             
         # Преобразование в numpy массив
-        query_embedding = embeddings.cpu().numpy()
+        return embeddings.cpu().numpy()
+    
+    def embed_query(self, query: str) -> np.ndarray:
+        """
+        Создание нормализованного эмбеддинга запроса (без расширения)
         
-        return query_embedding
+        Args:
+            query: текст запроса
+            
+        Returns:
+            Эмбеддинг запроса формы (1, dim)
+        """
+        return self._embed_queries([query])
+    
+    def _get_expanded_query(self, query: str) -> str:
+        """
+        Расширение запроса с кэшированием результата
+        
+        Args:
+            query: исходный запрос пользователя
+            
+        Returns:
+            Расширенный запрос
+        """
+        with self._cache_lock:
+            expanded_query = self._expansion_cache.get(query)
+        
+        if expanded_query is None:
+            expanded_query = self._expand_query(query)
+            with self._cache_lock:
+                self._expansion_cache[query] = expanded_query
+        
+        return expanded_query
     
     def _expand_query(self, query: str) -> str:
         """
@@ -156,53 +648,14 @@ class LegalRetriever:
         Returns:
             Расширенный запрос
         """
-        # Добавление юридических терминов и фраз
-        expansions = [
-            "юридические аспекты",
-            "правовые нормы",
-            "законодательство",
-            "федеральный закон",
-            "права и обязанности",
-            "правовой статус",
-            "юридическое понятие",
-            "согласно закону",
-            "нормативно-правовой акт"
-        ]
-        
-        # Поиск и удаление из запроса фраз, не относящихся к юридическим вопросам
-        remove_phrases = [
-            "скажи мне",
-            "расскажи о",
-            "что такое",
-            "как понять",
-            "объясни",
-            "можешь ли ты",
-            "пожалуйста",
-            "подскажи"
-        ]
-        
-        expanded_query = query
-        
-        # Удаление нерелевантных фраз
-        for phrase in remove_phrases:
-            expanded_query = expanded_query.replace(phrase, "")
-        
-        # Поиск наиболее релевантного расширения
-        best_expansion = None
-        max_overlap = -1
-        
-        for expansion in expansions:
-            # Простая метрика - количество общих слов
-            query_words = set(query.lower().split())
-            expansion_words = set(expansion.lower().split())
-            overlap = len(query_words.intersection(expansion_words))
-            
-            if overlap > max_overlap:
-                max_overlap = overlap
-                best_expansion = expansion
+        # Удаление нерелевантных фраз одним проходом
+        expanded_query = self._FILLER_RE.sub("", query)
         
         # Если запрос слишком короткий, добавляем юридический контекст
         if len(expanded_query.split()) < 3:
+            # Поиск наиболее релевантного расширения (простая метрика - количество общих слов)
+            query_words = frozenset(query.lower().split())
+            best_expansion, _ = max(self._EXPANSION_WORDSETS, key=lambda item: len(query_words & item[1]))
             expanded_query += f" {best_expansion}"
         
         # Очистка лишних пробелов
@@ -213,63 +666,78 @@ class LegalRetriever:
         
         return expanded_query
     
-    def search(self, query: str, is_legal_question: bool = True) -> List[Dict[str, Any]]:
+    def search(self, query: str, is_legal_question: Optional[bool] = None) -> List[Dict[str, Any]]:
         """
         Поиск релевантных документов по запросу
         
         Args:
             query: запрос пользователя
             is_legal_question: является ли запрос юридическим вопросом
+                               (если None, определяется по ключевым словам до построения эмбеддинга)
             
         Returns:
             Список словарей с релевантными документами и их метаданными
         """
+        if is_legal_question is None:
+            is_legal_question = self.is_legal_question(query)
+        
         if not is_legal_question:
             logger.info(f"Запрос не является юридическим вопросом: '{query}'")
             return []
         
+        return self.search_batch([query])[0]
+    
+    def search_batch(self, queries: List[str]) -> List[List[Dict[str, Any]]]:
+        """
+        Поиск релевантных документов сразу для нескольких запросов
+        
+        Эмбеддинги всех запросов строятся одним проходом модели, а поиск
+        по индексу выполняется одним вызовом.
+        
+        Args:
+            queries: запросы пользователей
+            
+        Returns:
+            Список результатов поиска для каждого запроса в том же порядке
+        """
         try:
-            # Расширение запроса, если включено
+            # Расширение запросов, если включено
             if self.use_query_expansion:
-                expanded_query = self._expand_query(query)
+                expanded_queries = [self._get_expanded_query(query) for query in queries]
             else:
-                expanded_query = query
-            
-            # Создание эмбеддинга запроса
-            query_embedding = self._embed_query(expanded_query)
+                expanded_queries = list(queries)
             
-            # Нормализация вектора
-            faiss.normalize_L2(query_embedding)
+            # Создание эмбеддингов запросов (уже нормализованы в _compute_embeddings)
+            query_embeddings = self._embed_queries(expanded_queries)
             
             # Поиск ближайших соседей
-            scores, indices = self.index.search(query_embedding, self.top_k)
+            scores, indices = self.index.search(query_embeddings, self.top_k)
             
-            # Формирование результатов
-            results = []
-            for i in range(len(indices[0])):
-                idx = indices[0][i]
-                score = float(scores[0][i])
-                
-                # Проверка валидности индекса
-                if idx < 0 or idx >= len(self.chunks):
-                    continue
+            # Проверка валидности индексов сразу для всего батча
+            valid = (indices >= 0) & (indices < len(self.chunks))
+            
+            # Формирование результатов (tolist() преобразует номера и оценки в числа Python за один вызов)
+            batch_results = []
+            for query, query_scores, query_indices, query_valid in zip(queries, scores, indices, valid):
+                results = [
+                    {
+                        "id": idx,
+                        "chunk": self.chunks[idx],
+                        "reference": self.references[idx],
+                        "score": score
+                    }
+                    for idx, score in zip(query_indices[query_valid].tolist(), query_scores[query_valid].tolist())
+                ]
                 
-                # Формирование результата
-                result = {
-                    "chunk": self.chunks[idx],
-                    "reference": self.references[idx],
-                    "score": score
-                }
-                results.append(result)
+                logger.info(f"Найдено {len(results)} релевантных документов для запроса: '{query}'")
+                batch_results.append(results)
             
-            logger.info(f"Найдено {len(results)} релевантных документов для запроса: '{query}'")
-            return results
+            return batch_results
             
-        except Exception as e:
-            logger.error(f"Ошибка при поиске документов: {e}")
-            import traceback
-            traceback.print_exc()
-            return []
+        except Exception:
+            # Трассировка стека попадает в лог вместе с сообщением, без отдельного вывода в stderr
+            logger.exception("Ошибка при поиске документов для запросов: %r", queries)
+            return [[] for _ in queries]
     
     def is_legal_question(self, query: str) -> bool:
         """
@@ -281,36 +749,11 @@ class LegalRetriever:
         Returns:
             True, если запрос является юридическим вопросом
         """
-        # Ключевые слова юридической тематики
-        legal_keywords = [
-            "закон", "право", "юрид", "кодекс", "статья", "суд", "догов", "норм",
-            "ответств", "регул", "легал", "законодат", "обязан", "регистрац",
-            "защит", "патент", "лиценз", "штраф", "санкц", "иск", "налог",
-            "имуществ", "наслед", "собствен", "возмещ", "компенс", "претенз",
-            "нотари", "адвокат", "доверен", "учред", "устав", "акционер", "директор"
-        ]
-        
-        # Проверка наличия ключевых слов в запросе
-        query_lower = query.lower()
-        
-        for keyword in legal_keywords:
-            if keyword in query_lower:
-                logger.info(f"Запрос определен как юридический (ключевое слово: '{keyword}'): '{query}'")
-                return True
-        
-        # Дополнительная проверка на наличие вопросов о правах, обязанностях и т.д.
-        legal_patterns = [
-            "имею ли я право", "можно ли", "законно ли", "правомерно ли",
-            "как правильно", "какие права", "какие обязанности", "что делать если",
-            "как оформить", "как получить", "как подать", "как заполнить",
-            "как составить", "как зарегистрировать", "что говорит закон",
-            "что сказано в законе", "по закону", "согласно закону"
-        ]
-        
-        for pattern in legal_patterns:
-            if pattern in query_lower:
-                logger.info(f"Запрос определен как юридический (паттерн: '{pattern}'): '{query}'")
-                return True
+        # Поиск ключевых слов и паттернов за один проход по запросу
+        match = self._LEGAL_RE.search(query.lower())
+        if match:
+            logger.info(f"Запрос определен как юридический (совпадение: '{match.group()}'): '{query}'")
+            return True
         
         logger.info(f"Запрос не определен как юридический: '{query}'")
         return False 
\ No newline at end of file
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Модуль кэша ответов по смысловой близости запросов.
+Предоставляет класс SemanticCache, который возвращает ранее сгенерированный
+ответ на вопрос, близкий по смыслу к уже заданному.
+"""
+
+import time
+import faiss
+import numpy as np
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+# Настройка логирования
+import logging
+logger = logging.getLogger(__name__)
+
+class SemanticCache:
+    """
+    Кэш ответов, индексированный нормализованными эмбеддингами запросов
+    """
+    
+    def __init__(self, dim: int, threshold: float = 0.95, ttl: int = 86400, max_entries: int = 10000):
+        """
+        Инициализация кэша
+        
+        Args:
+            dim: размерность эмбеддингов запросов
+            threshold: минимальное косинусное сходство запросов для выдачи ответа из кэша
+            ttl: время жизни записи в секундах
+            max_entries: максимальное количество записей; при переполнении вытесняются давно не использованные
+        """
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        
+        # Для нормализованных векторов скалярное произведение равно косинусному сходству
+        self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+        
+        # Ответы и время их добавления в порядке последнего использования
+        self.entries: "OrderedDict[int, Tuple[str, float]]" = OrderedDict()
+        self._next_id = 0
+    
+    def __len__(self) -> int:
+        return len(self.entries)
+    
+    def get(self, query_embedding: np.ndarray) -> Optional[str]:
+        """
+        Поиск ответа на близкий по смыслу запрос
+        
+        Args:
+            query_embedding: нормализованный эмбеддинг запроса формы (1, dim)
+            
+        Returns:
+            Сохраненный ответ или None, если близкого запроса нет
+        """
+        if not self.entries:
+            return None
+        
+        scores, ids = self.index.search(query_embedding, 1)
+        entry_id, score = int(ids[0, 0]), float(scores[0, 0])
+        if entry_id < 0 or score < self.threshold:
+            return None
+        
+        answer, created_at = self.entries[entry_id]
+        if time.time() - created_at > self.ttl:
+            self._remove(entry_id)
+            return None
+        
+        self.entries.move_to_end(entry_id)
+        logger.info(f"Найден близкий запрос в семантическом кэше (сходство {score:.3f})")
+        return answer
+    
+    def add(self, query_embedding: np.ndarray, answer: str):
+        """
+        Добавление ответа в кэш
+        
+        Args:
+            query_embedding: нормализованный эмбеддинг запроса формы (1, dim)
+            answer: ответ на запрос
+        """
+        entry_id = self._next_id
+        self._next_id += 1
+        
+        self.index.add_with_ids(query_embedding, np.array([entry_id], dtype=np.int64))
+        self.entries[entry_id] = (answer, time.time())
+        
+        while len(self.entries) > self.max_entries:
+            self._remove(next(iter(self.entries)))
+    
+    def _remove(self, entry_id: int):
+        """
+        Удаление записи из кэша
+        
+        Args:
+            entry_id: идентификатор записи
+        """
+        del self.entries[entry_id]
+        self.index.remove_ids(np.array([entry_id], dtype=np.int64))
@@ -0,0 +1,9 @@
+"""
+Общая настройка тестов: корень репозитория добавляется в путь импорта,
+чтобы тесты запускались командой pytest из корня без установки пакета.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
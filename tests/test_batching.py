@@ -0,0 +1,70 @@
+"""
+Тесты сбора запросов в батчи (_collect_batch)
+"""
+
+import asyncio
+
+from telegram_bot.bot import LegalGuardianBot
+
+
+def collect(items, batch_size, batch_window, late_items=(), delay=0.0):
+    """
+    Сбор батча из очереди с заранее добавленными и опоздавшими запросами
+    """
+    bot = LegalGuardianBot.__new__(LegalGuardianBot)
+    
+    async def run():
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        requests = {}
+        for name in items:
+            requests[name] = (name, loop.create_future())
+            queue.put_nowait(requests[name])
+        
+        async def put_late():
+            await asyncio.sleep(delay)
+            for name in late_items:
+                requests[name] = (name, loop.create_future())
+                queue.put_nowait(requests[name])
+        
+        late_task = asyncio.create_task(put_late())
+        batch = await bot._collect_batch(queue, batch_size, batch_window)
+        await late_task
+        return [name for name, _ in batch], queue.qsize()
+    
+    return asyncio.run(run())
+
+
+def test_batch_is_limited_by_size():
+    names, remaining = collect(["a", "b", "c"], batch_size=2, batch_window=0.01)
+    
+    assert names == ["a", "b"]
+    assert remaining == 1
+
+
+def test_requests_within_window_are_batched():
+    names, _ = collect(["a"], batch_size=4, batch_window=0.2, late_items=["b"], delay=0.01)
+    
+    assert names == ["a", "b"]
+
+
+def test_requests_after_window_wait_for_next_batch():
+    names, remaining = collect(["a"], batch_size=4, batch_window=0.01, late_items=["b"], delay=0.1)
+    
+    assert names == ["a"]
+    assert remaining == 1
+
+
+def test_cancelled_requests_are_skipped():
+    bot = LegalGuardianBot.__new__(LegalGuardianBot)
+    
+    async def run():
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        cancelled = loop.create_future()
+        cancelled.cancel()
+        queue.put_nowait(("a", cancelled))
+        queue.put_nowait(("b", loop.create_future()))
+        return await bot._collect_batch(queue, 4, 0.01)
+    
+    assert [name for name, _ in asyncio.run(run())] == ["b"]
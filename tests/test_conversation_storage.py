@@ -0,0 +1,147 @@
+"""
+Тесты хранения истории разговора в списках Redis (RPUSH/LTRIM и перезапись
+последнего сообщения) на упрощенной реализации клиента Redis в памяти
+"""
+
+import asyncio
+import json
+
+from telegram_bot.bot import REWRITE_TAIL_SCRIPT, LegalGuardianBot
+from telegram_bot.memory import ConversationMemory
+
+
+class FakePipeline:
+    """
+    Транзакция: команды копятся и выполняются при execute
+    """
+    
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        return False
+    
+    def __getattr__(self, name):
+        def queue(*args):
+            self.commands.append((name, args))
+        return queue
+    
+    async def execute(self):
+        return [getattr(self.client, name)(*args) for name, args in self.commands]
+
+
+class FakeRedis:
+    """
+    Хранилище списков с командами, которые использует бот
+    """
+    
+    def __init__(self):
+        self.lists = {}
+        self.ttls = {}
+    
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+    
+    def rpush(self, key, *values):
+        self.lists.setdefault(key, []).extend(values)
+        return len(self.lists[key])
+    
+    def ltrim(self, key, start, end):
+        if key in self.lists:
+            items = self.lists[key]
+            stop = len(items) + end + 1 if end < 0 else end + 1
+            self.lists[key] = items[max(len(items) + start, 0) if start < 0 else start:stop]
+    
+    def expire(self, key, ttl):
+        self.ttls[key] = ttl
+    
+    def eval(self, script, numkeys, key, value):
+        assert script == REWRITE_TAIL_SCRIPT
+        if self.lists.get(key):
+            self.lists[key][-1] = value
+        else:
+            self.rpush(key, value)
+    
+    async def lrange(self, key, start, end):
+        return list(self.lists.get(key, []))
+    
+    async def delete(self, key):
+        self.lists.pop(key, None)
+
+
+def make_bot(max_history=4):
+    bot = LegalGuardianBot.__new__(LegalGuardianBot)
+    bot.redis_client = FakeRedis()
+    bot.max_history = max_history
+    bot.conversation_ttl = 60
+    return bot
+
+
+def stored_messages(bot, user_id=1):
+    return [json.loads(item) for item in bot.redis_client.lists.get(f"chat:{user_id}", [])]
+
+
+def test_new_messages_are_appended_and_trimmed():
+    bot = make_bot(max_history=2)
+    memory = ConversationMemory(max_history=2)
+    
+    memory.add_message("user", "вопрос 1")
+    memory.add_message("assistant", "ответ 1")
+    asyncio.run(bot.save_conversation_memory(1, memory))
+    memory.add_message("user", "вопрос 2")
+    asyncio.run(bot.save_conversation_memory(1, memory))
+    
+    assert stored_messages(bot) == [
+        {"role": "assistant", "content": "ответ 1"},
+        {"role": "user", "content": "вопрос 2"},
+    ]
+    assert memory.unsaved_messages == 0
+    assert bot.redis_client.ttls["chat:1"] == 60
+
+
+def test_merge_into_saved_message_rewrites_tail():
+    bot = make_bot()
+    memory = ConversationMemory()
+    memory.add_message("user", "первый")
+    asyncio.run(bot.save_conversation_memory(1, memory))
+    
+    memory.add_message("user", "второй")
+    memory.add_message("assistant", "ответ")
+    asyncio.run(bot.save_conversation_memory(1, memory))
+    
+    assert stored_messages(bot) == [
+        {"role": "user", "content": "первый\nвторой"},
+        {"role": "assistant", "content": "ответ"},
+    ]
+    assert not memory.tail_modified
+
+
+def test_merge_is_kept_when_stored_list_is_gone():
+    bot = make_bot()
+    memory = ConversationMemory()
+    memory.add_message("user", "первый")
+    asyncio.run(bot.save_conversation_memory(1, memory))
+    
+    # История в Redis истекла после загрузки
+    asyncio.run(bot.redis_client.delete("chat:1"))
+    memory.add_message("user", "второй")
+    asyncio.run(bot.save_conversation_memory(1, memory))
+    
+    assert stored_messages(bot) == [{"role": "user", "content": "первый\nвторой"}]
+
+
+def test_history_round_trip():
+    bot = make_bot()
+    memory = ConversationMemory(max_history=4)
+    memory.add_message("user", "вопрос")
+    memory.add_message("assistant", "ответ")
+    asyncio.run(bot.save_conversation_memory(1, memory))
+    
+    loaded = asyncio.run(bot.get_conversation_memory(1))
+    
+    assert loaded.get_history() == memory.get_history()
+    assert loaded.unsaved_messages == 0
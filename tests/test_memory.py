@@ -0,0 +1,74 @@
+"""
+Тесты учета несохраненных сообщений в ConversationMemory
+"""
+
+import pytest
+
+from telegram_bot.memory import ConversationMemory
+
+
+def test_new_messages_are_counted_as_unsaved():
+    memory = ConversationMemory(max_history=4)
+    memory.add_message("user", "вопрос")
+    memory.add_message("assistant", "ответ")
+    
+    assert memory.unsaved_messages == 2
+    assert not memory.tail_modified
+    assert memory.get_last_n_messages(memory.unsaved_messages) == [
+        {"role": "user", "content": "вопрос"},
+        {"role": "assistant", "content": "ответ"},
+    ]
+
+
+def test_unsaved_counter_is_capped_by_max_history():
+    memory = ConversationMemory(max_history=2)
+    for i in range(3):
+        memory.add_message("user", f"вопрос {i}")
+        memory.add_message("assistant", f"ответ {i}")
+    
+    assert len(memory.messages) == 2
+    assert memory.unsaved_messages == 2
+
+
+def test_merge_into_unsaved_message_does_not_mark_tail():
+    memory = ConversationMemory()
+    memory.add_message("user", "первый")
+    memory.add_message("user", "второй")
+    
+    assert memory.get_history() == [{"role": "user", "content": "первый\nвторой"}]
+    assert memory.unsaved_messages == 1
+    assert not memory.tail_modified
+
+
+def test_merge_into_saved_message_marks_tail():
+    memory = ConversationMemory()
+    memory.add_message("user", "первый")
+    memory.unsaved_messages = 0
+    
+    memory.add_message("user", "второй")
+    
+    assert memory.unsaved_messages == 0
+    assert memory.tail_modified
+    
+    memory.add_message("assistant", "ответ")
+    assert memory.unsaved_messages == 1
+    assert memory.tail_modified
+
+
+def test_clear_resets_bookkeeping():
+    memory = ConversationMemory()
+    memory.add_message("user", "вопрос")
+    memory.unsaved_messages = 0
+    memory.add_message("user", "уточнение")
+    
+    memory.clear()
+    
+    assert memory.get_history() == []
+    assert memory.unsaved_messages == 0
+    assert not memory.tail_modified
+
+
+def test_invalid_role_is_rejected():
+    memory = ConversationMemory()
+    with pytest.raises(ValueError):
+        memory.add_message("system", "текст")
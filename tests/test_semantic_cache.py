@@ -0,0 +1,51 @@
+"""
+Тесты кэша ответов по смысловой близости запросов
+"""
+
+import numpy as np
+
+from telegram_bot.semantic_cache import SemanticCache
+
+
+def embedding(*values):
+    vector = np.array([values], dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def test_close_query_returns_cached_answer():
+    cache = SemanticCache(dim=3, threshold=0.95)
+    cache.add(embedding(1, 0, 0), "ответ")
+    
+    assert cache.get(embedding(1, 0.05, 0)) == "ответ"
+
+
+def test_distant_query_misses():
+    cache = SemanticCache(dim=3, threshold=0.95)
+    cache.add(embedding(1, 0, 0), "ответ")
+    
+    assert cache.get(embedding(0, 1, 0)) is None
+    assert SemanticCache(dim=3).get(embedding(1, 0, 0)) is None
+
+
+def test_expired_entry_is_removed():
+    cache = SemanticCache(dim=3, ttl=-1)
+    cache.add(embedding(1, 0, 0), "ответ")
+    
+    assert cache.get(embedding(1, 0, 0)) is None
+    assert len(cache) == 0
+    assert cache.index.ntotal == 0
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = SemanticCache(dim=3, max_entries=2)
+    cache.add(embedding(1, 0, 0), "первый")
+    cache.add(embedding(0, 1, 0), "второй")
+    
+    # Обращение делает первую запись недавно использованной
+    assert cache.get(embedding(1, 0, 0)) == "первый"
+    cache.add(embedding(0, 0, 1), "третий")
+    
+    assert len(cache) == 2
+    assert cache.get(embedding(0, 1, 0)) is None
+    assert cache.get(embedding(1, 0, 0)) == "первый"
+    assert cache.get(embedding(0, 0, 1)) == "третий"
@@ -0,0 +1,32 @@
+"""
+Тесты регулярного выражения в виде префиксного дерева (compile_trie_pattern)
+"""
+
+import re
+
+from telegram_bot.retriever import LegalRetriever, compile_trie_pattern
+
+
+def test_matches_same_texts_as_plain_alternation():
+    words = ["закон", "законодат", "законно ли", "суд", "судебн", "иск", "a.b"]
+    trie_re = compile_trie_pattern(words)
+    plain_re = re.compile("|".join(map(re.escape, words)))
+    
+    texts = ["закон", "законодательство", "законно ли это", "в суде", "риск",
+             "ничего", "", "зако", "a.b", "axb"]
+    for text in texts:
+        assert bool(trie_re.search(text)) == bool(plain_re.search(text)), text
+
+
+def test_special_characters_are_escaped():
+    pattern = compile_trie_pattern(["ст. 1", "(ч. 2)"])
+    
+    assert pattern.search("см. ст. 1 кодекса")
+    assert pattern.search("статья 5 (ч. 2)")
+    assert not pattern.search("ст 1")
+
+
+def test_legal_pattern_covers_keywords_and_phrases():
+    assert LegalRetriever._LEGAL_RE.search("как оформить наследство")
+    assert LegalRetriever._LEGAL_RE.search("что говорит закон о штрафах")
+    assert not LegalRetriever._LEGAL_RE.search("какая сегодня погода")